@@ -0,0 +1,537 @@
+'''Microbenchmarks for the code in this chapter.
+
+Run all of them with:
+
+    python bench.py
+
+or only some of them by name:
+
+    python bench.py point_validation
+'''
+from io import BytesIO
+from random import randint
+from sys import argv
+from timeit import timeit
+
+import gc
+import json
+import tracemalloc
+
+from block import Block, GENESIS_BLOCK
+from helper import (
+    BASE58_ALPHABET,
+    decode_base58_many,
+    encode_base58_many,
+    encode_varint,
+    hash256,
+    hash256_from,
+    int_to_little_endian,
+    read_varint,
+    sha256,
+    sha256_midstate,
+    tagged_hash,
+)
+from script import p2pkh_script, Script
+from tx import LazyTx, Tx, TxIn, TxOut
+from ecc import (
+    G,
+    INVERSION_METHODS,
+    N,
+    P,
+    Point,
+    PrivateKey,
+    S256Point,
+    Signature,
+    inverse,
+    multi_mul,
+    verify_batch,
+    verify_schnorr_batch,
+)
+
+
+def report(name, seconds, number):
+    '''Prints the average time per call in microseconds'''
+    print('{:<50} {:>12.1f} us'.format(name, seconds / number * 1e6))
+
+
+class CheckedS256Point(S256Point):
+    '''S256Point that validates every point the group law produces,
+    which is what Point.__add__ used to do'''
+
+    @classmethod
+    def trusted(cls, x, y, a, b):
+        return cls(x, y)
+
+
+def bench_point_validation(number=5):
+    '''Affine double-and-add with and without re-checking the curve
+    equation for every intermediate point'''
+    secret = 0xc0ffee * 2**200 + 0xdeadbeef
+    checked = CheckedS256Point(G.x, G.y)
+    report('affine k*G, validating every point',
+           timeit(lambda: Point.__rmul__(checked, secret), number=number),
+           number)
+    report('affine k*G, trusted group law',
+           timeit(lambda: Point.__rmul__(G, secret), number=number),
+           number)
+    report('S256Point construction, validated',
+           timeit(lambda: S256Point(G.x, G.y), number=number * 1000),
+           number * 1000)
+    report('S256Point construction, trusted',
+           timeit(lambda: S256Point.trusted(G.x, G.y, G.a, G.b),
+                  number=number * 1000),
+           number * 1000)
+
+
+def bench_inversion(number=200):
+    '''Each modular inversion method for the field and the group order'''
+    for name, modulus in (('P', P), ('N', N)):
+        num = randint(1, modulus - 1)
+        for method in INVERSION_METHODS:
+            try:
+                inverse(num, modulus, method=method)
+            except ValueError:
+                # pow(num, -1, modulus) needs Python 3.8
+                continue
+            report('inverse mod {} ({})'.format(name, method),
+                   timeit(lambda: inverse(num, modulus, method=method),
+                          number=number),
+                   number)
+
+
+def bench_glv(number=50):
+    '''Variable base u*G + v*P with and without the GLV endomorphism'''
+    point = randint(1, N) * G
+    scalars = [randint(1, N), randint(1, N)]
+    for glv in (False, True):
+        report('u*G + v*P (glv={})'.format(glv),
+               timeit(lambda: multi_mul(scalars, [G, point], glv=glv),
+                      number=number),
+               number)
+
+
+def bench_signing(count=200):
+    '''Signing count hashes one at a time and with sign_many'''
+    private_key = PrivateKey(randint(1, N))
+    zs = [randint(0, 2**256) for _ in range(count)]
+    report('PrivateKey.sign',
+           timeit(lambda: [private_key.sign(z) for z in zs], number=1),
+           count)
+    report('PrivateKey.sign_many',
+           timeit(lambda: private_key.sign_many(zs), number=1),
+           count)
+
+
+def bench_hardened(number=20):
+    '''Signing with the fast variable time code and the hardened mode'''
+    secret = randint(1, N)
+    z = randint(0, 2**256)
+    for hardened in (False, True):
+        private_key = PrivateKey(secret, hardened=hardened)
+        report('PrivateKey.sign (hardened={})'.format(hardened),
+               timeit(lambda: private_key.sign(z), number=number),
+               number)
+
+
+def bench_schnorr(count=64):
+    '''Verifying count signatures as ECDSA, as Schnorr one at a time and
+    as a single Schnorr batch'''
+    keys = [PrivateKey(randint(1, N)) for _ in range(count)]
+    msgs = [randint(0, 2**256).to_bytes(32, 'big') for _ in range(count)]
+    ecdsa = [(key.point, int.from_bytes(msg, 'big'),
+              key.sign(int.from_bytes(msg, 'big')))
+             for key, msg in zip(keys, msgs)]
+    schnorr = [(key.point, msg, key.sign_schnorr(msg))
+               for key, msg in zip(keys, msgs)]
+    report('ECDSA verify_batch',
+           timeit(lambda: verify_batch(ecdsa), number=1), count)
+    report('Schnorr verify_schnorr, one at a time',
+           timeit(lambda: [point.verify_schnorr(msg, sig)
+                           for point, msg, sig in schnorr], number=1),
+           count)
+    report('Schnorr verify_schnorr_batch',
+           timeit(lambda: verify_schnorr_batch(schnorr), number=1), count)
+
+
+def parse_der_bytesio(signature_bin):
+    '''The DER parser Signature.parse used to be, reading one byte at a
+    time from a BytesIO'''
+    s = BytesIO(signature_bin)
+    compound = s.read(1)[0]
+    if compound != 0x30:
+        raise SyntaxError("Bad Signature")
+    length = s.read(1)[0]
+    if length + 2 != len(signature_bin):
+        raise SyntaxError("Bad Signature Length")
+    marker = s.read(1)[0]
+    if marker != 0x02:
+        raise SyntaxError("Bad Signature")
+    rlength = s.read(1)[0]
+    r = int.from_bytes(s.read(rlength), 'big')
+    marker = s.read(1)[0]
+    if marker != 0x02:
+        raise SyntaxError("Bad Signature")
+    slength = s.read(1)[0]
+    s = int.from_bytes(s.read(slength), 'big')
+    if len(signature_bin) != 6 + rlength + slength:
+        raise SyntaxError("Signature too long")
+    return Signature(r, s)
+
+
+def der_concatenate(sig):
+    '''The DER serializer Signature.der used to be'''
+    rbin = sig.r.to_bytes(32, byteorder='big').lstrip(b'\x00')
+    if rbin[0] & 0x80:
+        rbin = b'\x00' + rbin
+    result = bytes([2, len(rbin)]) + rbin
+    sbin = sig.s.to_bytes(32, byteorder='big').lstrip(b'\x00')
+    if sbin[0] & 0x80:
+        sbin = b'\x00' + sbin
+    result += bytes([2, len(sbin)]) + sbin
+    return bytes([0x30, len(result)]) + result
+
+
+def bench_der(number=20000):
+    '''DER parsing from the middle of a script buffer and serializing'''
+    sig = PrivateKey(randint(1, N)).sign(randint(0, 2**256))
+    der = sig.der()
+    # the signature as it sits in a ScriptSig, with the hash type after it
+    script_sig = b'\x48' + der + b'\x01'
+    view = memoryview(script_sig)
+    report('parse, BytesIO of a copied slice',
+           timeit(lambda: parse_der_bytesio(script_sig[1:-1]), number=number),
+           number)
+    report('parse, memoryview slice',
+           timeit(lambda: Signature.parse(view[1:-1]), number=number),
+           number)
+    report('parse, memoryview slice, strict',
+           timeit(lambda: Signature.parse(view[1:-1], strict=True), number=number),
+           number)
+    report('der, concatenation',
+           timeit(lambda: der_concatenate(sig), number=number),
+           number)
+    report('der, single join',
+           timeit(lambda: sig.der(), number=number),
+           number)
+
+
+def bench_hashing(number=20000):
+    '''hash256 of a constant prefix plus a short suffix, hashing the
+    whole preimage and copying a midstate'''
+    # version + hashPrevouts + hashSequence, as in a BIP143 preimage
+    prefix = bytes(68)
+    suffix = bytes(36 + 26 + 8 + 4 + 32 + 4 + 4)
+    midstate = sha256_midstate(prefix)
+    report('BIP143 preimage, whole',
+           timeit(lambda: hash256(prefix + suffix), number=number), number)
+    report('BIP143 preimage, midstate',
+           timeit(lambda: hash256_from(midstate, suffix), number=number),
+           number)
+    tag_hash = sha256(b'BIP0340/challenge')
+    msg = bytes(96)
+    report('tagged hash, hashing the tag every time',
+           timeit(lambda: sha256(sha256(b'BIP0340/challenge') * 2 + msg),
+                  number=number),
+           number)
+    report('tagged hash, tag hash precomputed',
+           timeit(lambda: sha256(tag_hash + tag_hash + msg), number=number),
+           number)
+    report('tagged hash, midstate',
+           timeit(lambda: tagged_hash('BIP0340/challenge', msg),
+                  number=number),
+           number)
+
+
+def bench_mining(count=100000):
+    '''Nonce grinding with check_pow against Block.mine'''
+    block = Block.parse(BytesIO(GENESIS_BLOCK))
+    # a target nothing will meet so every nonce is tried
+    block.bits = bytes.fromhex('00000001')
+
+    def check_pow_loop():
+        for nonce in range(count):
+            block.nonce = nonce.to_bytes(4, 'little')
+            block.check_pow()
+    report('check_pow per nonce', timeit(check_pow_loop, number=1), count)
+    report('Block.mine per nonce',
+           timeit(lambda: block.mine(0, count), number=1), count)
+    print('{:<50} {:>12.0f}'.format(
+        'Block.mine hashes/s', block.hashes_per_second))
+
+
+def load_block_txs(filename='../tx.cache', copies=50):
+    '''Returns the raw transactions of the tx cache repeated copies times
+    and laid out like the transactions of a block'''
+    with open(filename) as f:
+        raws = [bytes.fromhex(raw_hex) for raw_hex in json.load(f).values()]
+    raws = raws * copies
+    return raws, encode_varint(len(raws)) + b''.join(raws)
+
+
+def peak_memory(function):
+    '''Returns the peak bytes allocated while running function, keeping
+    its result alive until the end'''
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def bench_parsing():
+    '''Parsing a block worth of transactions from a BytesIO and from a
+    memoryview'''
+    raws, block = load_block_txs()
+    count = len(raws)
+
+    def parse_stream():
+        s = BytesIO(block)
+        return [Tx.parse(s) for _ in range(read_varint(s))]
+
+    def parse_buffer():
+        return Tx.parse_many(block)[0]
+
+    def parse_lazy():
+        return LazyTx.parse_many(block)[0]
+
+    def ids_and_amounts(parse):
+        txs = parse()
+        return [(tx.id(), [tx_out.amount for tx_out in tx.tx_outs])
+                for tx in txs], txs
+
+    report('Tx.parse from a BytesIO',
+           timeit(parse_stream, number=1), count)
+    report('Tx.parse_many from a memoryview',
+           timeit(parse_buffer, number=1), count)
+    report('LazyTx.parse_many',
+           timeit(parse_lazy, number=1), count)
+    report('ids and amounts, Tx.parse_many',
+           timeit(lambda: ids_and_amounts(parse_buffer), number=1), count)
+    report('ids and amounts, LazyTx.parse_many',
+           timeit(lambda: ids_and_amounts(parse_lazy), number=1), count)
+    print('{:<50} {:>12}'.format('block size (bytes)', len(block)))
+    for name, parse in (('BytesIO', parse_stream),
+                        ('memoryview', parse_buffer),
+                        ('LazyTx', parse_lazy)):
+        print('{:<50} {:>12}'.format(
+            'peak allocated, {} (bytes)'.format(name), peak_memory(parse)))
+
+
+def resident_memory(function, count):
+    '''Returns the bytes per item still allocated by the count items
+    function returns'''
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size // count
+
+
+def bench_memory():
+    '''The memory each parsed transaction keeps resident, against its
+    raw size'''
+    raws, block = load_block_txs()
+    count = len(raws)
+
+    def parse_stream():
+        return [Tx.parse(BytesIO(raw)) for raw in raws]
+
+    def parse_buffer():
+        return Tx.parse_many(block)[0]
+
+    def parse_scripts():
+        # the way verifying leaves them, every script split into cmds
+        txs = Tx.parse_many(block)[0]
+        for tx in txs:
+            for tx_in in tx.tx_ins:
+                tx_in.script_sig.cmds
+            for tx_out in tx.tx_outs:
+                tx_out.script_pubkey.cmds
+        return txs
+
+    def parse_lazy():
+        return LazyTx.parse_many(block)[0]
+
+    print('{:<50} {:>12}'.format('raw (bytes per tx)', len(block) // count))
+    for name, parse in (('Tx.parse', parse_stream),
+                        ('Tx.parse_many', parse_buffer),
+                        ('Tx.parse_many, scripts parsed', parse_scripts),
+                        ('LazyTx.parse_many', parse_lazy)):
+        print('{:<50} {:>12}'.format(
+            '{} (bytes per tx)'.format(name), resident_memory(parse, count)))
+
+
+def bench_ids(number=2000):
+    '''Looking up the id of a parsed transaction again and again, and
+    what each lookup used to cost'''
+    raws, _ = load_block_txs(copies=1)
+    tx = Tx.parse(BytesIO(max(raws, key=len)))
+    report('Tx.id, rebuilding the serialization',
+           timeit(lambda: hash256(tx.build_legacy())[::-1].hex(),
+                  number=number),
+           number)
+    report('Tx.id, cached',
+           timeit(lambda: tx.id(), number=number), number)
+
+
+def script_concatenate(script):
+    '''The Script serialization with a bytes += for every cmd'''
+    result = b''
+    for cmd in script.cmds:
+        if type(cmd) == int:
+            result += int_to_little_endian(cmd, 1)
+        else:
+            length = len(cmd)
+            if length < 75:
+                result += int_to_little_endian(length, 1)
+            elif length < 0x100:
+                result += int_to_little_endian(76, 1)
+                result += int_to_little_endian(length, 1)
+            else:
+                result += int_to_little_endian(77, 1)
+                result += int_to_little_endian(length, 2)
+            result += cmd
+    return encode_varint(len(result)) + result
+
+
+def tx_concatenate(tx):
+    '''The legacy serialization the way Tx, TxIn and TxOut used to
+    build it, concatenating bytes'''
+    result = int_to_little_endian(tx.version, 4)
+    result += encode_varint(len(tx.tx_ins))
+    for tx_in in tx.tx_ins:
+        item = tx_in.prev_tx[::-1]
+        item += int_to_little_endian(tx_in.prev_index, 4)
+        item += script_concatenate(tx_in.script_sig)
+        item += int_to_little_endian(tx_in.sequence, 4)
+        result += item
+    result += encode_varint(len(tx.tx_outs))
+    for tx_out in tx.tx_outs:
+        item = int_to_little_endian(tx_out.amount, 8)
+        item += script_concatenate(tx_out.script_pubkey)
+        result += item
+    result += int_to_little_endian(tx.locktime, 4)
+    return result
+
+
+def consolidation_tx(num_inputs):
+    '''A transaction spending num_inputs p2pkh outputs to one output'''
+    private_key = PrivateKey(randint(1, N))
+    sec = private_key.point.sec()
+    der = private_key.sign(randint(0, 2**256)).der() + b'\x01'
+    tx_ins = [TxIn(randint(0, 2**256).to_bytes(32, 'big'), i,
+                   Script([der, sec]))
+              for i in range(num_inputs)]
+    tx_outs = [TxOut(num_inputs * 10000, p2pkh_script(bytes(20)))]
+    return Tx(1, tx_ins, tx_outs, 0)
+
+
+def bench_serializing(num_inputs=5000, number=10):
+    '''Serializing a large consolidation transaction and a block of
+    transactions, concatenating bytes and writing into one bytearray'''
+    tx = consolidation_tx(num_inputs)
+    assert tx_concatenate(tx) == tx.build_legacy()
+    report('consolidation tx, concatenation',
+           timeit(lambda: tx_concatenate(tx), number=number), number)
+    report('consolidation tx, serialize_into',
+           timeit(lambda: tx.build_legacy(), number=number), number)
+    # tx_concatenate only writes the legacy serialization
+    raws, _ = load_block_txs(copies=10)
+    txs = [tx for tx in (Tx.parse(BytesIO(raw)) for raw in raws)
+           if not tx.segwit]
+    block = Tx.serialize_many(txs)
+    report('block of txs, concatenation and join',
+           timeit(lambda: encode_varint(len(txs)) + b''.join(
+               tx_concatenate(tx) for tx in txs), number=1), len(txs))
+    report('block of txs, Tx.serialize_many',
+           timeit(lambda: Tx.serialize_many(txs), number=1), len(txs))
+    cached = Tx.parse_many(block)[0]
+    report('block of txs, Tx.serialize_many, cached',
+           timeit(lambda: Tx.serialize_many(cached), number=1), len(txs))
+
+
+def encode_base58_prepend(s):
+    '''The base58 encoder helper.py used to have, prepending one
+    character at a time'''
+    count = 0
+    for c in s:
+        if c == 0:
+            count += 1
+        else:
+            break
+    num = int.from_bytes(s, 'big')
+    prefix = '1' * count
+    result = ''
+    while num > 0:
+        num, mod = divmod(num, 58)
+        result = BASE58_ALPHABET[mod] + result
+    return prefix + result
+
+
+def decode_base58_index(s):
+    '''The base58 address decoder helper.py used to have'''
+    num = 0
+    for c in s:
+        num *= 58
+        num += BASE58_ALPHABET.index(c)
+    combined = num.to_bytes(25, byteorder='big')
+    checksum = combined[-4:]
+    if hash256(combined[:-4])[:4] != checksum:
+        raise ValueError('bad address')
+    return combined[1:-4]
+
+
+def bench_base58(count=2000):
+    '''Encoding and decoding count p2pkh addresses and xpub sized
+    payloads'''
+    payloads = [b'\x00' + randint(0, 2**160).to_bytes(20, 'big')
+                for _ in range(count)]
+    addresses = encode_base58_many(payloads)
+    report('address encode, prepending',
+           timeit(lambda: [encode_base58_prepend(p + hash256(p)[:4])
+                           for p in payloads], number=1),
+           count)
+    report('address encode, encode_base58_many',
+           timeit(lambda: encode_base58_many(payloads), number=1), count)
+    report('address decode, str.index',
+           timeit(lambda: [decode_base58_index(a) for a in addresses],
+                  number=1),
+           count)
+    report('address decode, decode_base58_many',
+           timeit(lambda: decode_base58_many(addresses), number=1), count)
+    xpubs = [randint(0, 2**(78 * 8)).to_bytes(78, 'big')
+             for _ in range(count)]
+    report('xpub encode, prepending',
+           timeit(lambda: [encode_base58_prepend(p + hash256(p)[:4])
+                           for p in xpubs], number=1),
+           count)
+    report('xpub encode, encode_base58_many',
+           timeit(lambda: encode_base58_many(xpubs), number=1), count)
+
+
+BENCHMARKS = {
+    'point_validation': bench_point_validation,
+    'inversion': bench_inversion,
+    'glv': bench_glv,
+    'signing': bench_signing,
+    'hardened': bench_hardened,
+    'schnorr': bench_schnorr,
+    'der': bench_der,
+    'base58': bench_base58,
+    'hashing': bench_hashing,
+    'mining': bench_mining,
+    'parsing': bench_parsing,
+    'ids': bench_ids,
+    'memory': bench_memory,
+    'serializing': bench_serializing,
+}
+
+
+if __name__ == '__main__':
+    names = argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('== {}'.format(name))
+        BENCHMARKS[name]()
@@ -1,15 +1,24 @@
 from io import BytesIO
+from logging import getLogger
+from time import perf_counter
 from unittest import TestCase
 
+import hashlib
+
 from helper import (
     bits_to_target,
+    Executor,
     hash256,
     int_to_little_endian,
     little_endian_to_int,
     merkle_root,
+    sha256_midstate,
 )
 
 
+LOGGER = getLogger(__name__)
+
+
 GENESIS_BLOCK = bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c')
 TESTNET_GENESIS_BLOCK = bytes.fromhex('0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff001d1aa4ae18')
 LOWEST_BITS = bytes.fromhex('ffff001d')
@@ -110,6 +119,47 @@ class Block:
         # return whether this integer is less than the target
         return proof < self.target()
 
+    def mine(self, start_nonce=0, max_iters=2**32, executor=None,
+             nonces_per_worker=2**20):
+        '''Looks for a nonce from start_nonce on, trying at most max_iters
+        of them, that makes this block satisfy proof of work. Sets
+        self.nonce and returns True if one is found.
+        With an Executor the nonces are split between its workers in
+        rounds of nonces_per_worker each, stopping after the first round
+        that finds one.
+        The hash rate is logged and kept in self.hashes_per_second.'''
+        stop = min(start_nonce + max_iters, 2**32)
+        header = self.serialize()[:76]
+        target = self.target()
+        start = perf_counter()
+        if executor is None:
+            nonce, hashes = mine_nonces((header, target, start_nonce, stop))
+        else:
+            # workers can't be stopped once they've started, so hand out
+            # small rounds to bound the hashes done after a nonce is found
+            nonce, hashes = None, 0
+            round_start = start_nonce
+            while nonce is None and round_start < stop:
+                round_stop = min(
+                    round_start + executor.workers * nonces_per_worker, stop)
+                payloads = [
+                    (header, target, low, min(low + nonces_per_worker, stop))
+                    for low in range(
+                        round_start, round_stop, nonces_per_worker)]
+                for found, tried in executor.map(mine_nonces, payloads):
+                    hashes += tried
+                    if nonce is None and found is not None:
+                        nonce = found
+                round_start = round_stop
+        seconds = perf_counter() - start
+        self.hashes_per_second = hashes / seconds if seconds else 0
+        LOGGER.info('{} hashes in {:.2f}s, {:.0f} hashes/s'.format(
+            hashes, seconds, self.hashes_per_second))
+        if nonce is None:
+            return False
+        self.nonce = int_to_little_endian(nonce, 4)
+        return True
+
     def validate_merkle_root(self):
         '''Gets the merkle root of the tx_hashes and checks that it's
         the same as the merkle root of this block.
@@ -122,6 +172,25 @@ class Block:
         return root == self.merkle_root
 
 
+def mine_nonces(payload):
+    '''Takes (first 76 header bytes, target, start, stop) and returns
+    (first nonce in range(start, stop) that meets the target or None,
+    number of hashes tried)'''
+    header, target, start, stop = payload
+    # the first 64 bytes never change, so their sha256 block is hashed
+    # once and only the last 16 bytes are hashed for each nonce
+    midstate = sha256_midstate(header[:64])
+    tail = header[64:]
+    sha256 = hashlib.sha256
+    from_bytes = int.from_bytes
+    for nonce in range(start, stop):
+        h = midstate.copy()
+        h.update(tail + nonce.to_bytes(4, 'little'))
+        if from_bytes(sha256(h.digest()).digest(), 'little') < target:
+            return nonce, nonce - start + 1
+    return None, stop - start
+
+
 class BlockTest(TestCase):
 
     def test_parse(self):
@@ -202,6 +271,37 @@ class BlockTest(TestCase):
         block = Block.parse(stream)
         self.assertFalse(block.check_pow())
 
+    def test_mine(self):
+        block = Block.parse(BytesIO(GENESIS_BLOCK))
+        # about 1 in 256 hashes meets this target
+        block.bits = bytes.fromhex('ffff0020')
+        want = None
+        for nonce in range(2000):
+            block.nonce = int_to_little_endian(nonce, 4)
+            if block.check_pow():
+                want = nonce
+                break
+        block.nonce = b'\x00' * 4
+        self.assertTrue(block.mine())
+        self.assertEqual(little_endian_to_int(block.nonce), want)
+        self.assertTrue(block.check_pow())
+        self.assertGreater(block.hashes_per_second, 0)
+        self.assertFalse(block.mine(start_nonce=0, max_iters=want))
+        with Executor(workers=2) as executor:
+            block.nonce = b'\x00' * 4
+            self.assertTrue(block.mine(max_iters=4 * want, executor=executor))
+            self.assertEqual(little_endian_to_int(block.nonce), want)
+            # rounds stop soon after the nonce is found
+            block.nonce = b'\x00' * 4
+            with self.assertLogs(LOGGER, 'INFO') as logs:
+                self.assertTrue(block.mine(executor=executor,
+                                           nonces_per_worker=16))
+            self.assertEqual(little_endian_to_int(block.nonce), want)
+            hashes = int(logs.output[-1].split(':')[-1].split()[0])
+            self.assertLess(hashes, want + 2 * 16)
+            self.assertFalse(block.mine(max_iters=want, executor=executor,
+                                        nonces_per_worker=16))
+
     def test_validate_merkle_root(self):
         hashes_hex = [
             'f54cb69e5dc1bd38ee6901e4ec2007a5030e14bdd60afb4d2f3428c88eea17c1',
@@ -1,14 +1,99 @@
-from io import BytesIO
-from random import randint
+from collections import OrderedDict
+from random import randint, SystemRandom
 from unittest import TestCase
+from unittest.mock import patch
 
 import hashlib
 import hmac
 
-from helper import encode_base58_checksum, hash160
+from helper import encode_base58_checksum, hash160, tagged_hash
+
+
+def inverse_fermat(num, modulus):
+    '''1/num by Fermat's little theorem, num**(p-1) == 1 so
+    1/num == num**(p-2). Only works for a prime modulus.'''
+    return pow(num, modulus - 2, modulus)
+
+
+def inverse_pow(num, modulus):
+    '''1/num using the extended Euclidean algorithm built into pow,
+    which needs Python 3.8 or higher'''
+    return pow(num, -1, modulus)
+
+
+def inverse_safegcd(num, modulus):
+    '''1/num for an odd modulus using the divsteps of Bernstein and Yang's
+    safegcd. The number of steps only depends on the size of the modulus
+    and every step does the same arithmetic whatever the bits of num are,
+    so this is the one to use for secret values. Python integers are not
+    constant time themselves, so this hides much less than it would in C.'''
+    bits = modulus.bit_length()
+    if bits < 46:
+        iterations = (49 * bits + 80) // 17
+    else:
+        iterations = (49 * bits + 57) // 17
+    # invariants: f == d * num and g == e * num (mod modulus)
+    delta, f, g, d, e = 1, modulus, num % modulus, 0, 1
+    for _ in range(iterations):
+        # swap is 1 when delta > 0 and g is odd
+        swap = (delta > 0) & g & 1
+        # if swap: (delta, f, g, d, e) = (-delta, g, -f, e, -d)
+        delta -= 2 * swap * delta
+        f, g = f + swap * (g - f), g - swap * (g + f)
+        d, e = d + swap * (e - d), e - swap * (e + d)
+        # now g is even or f and g are both odd, so g + (g & 1)*f is even
+        g_odd = g & 1
+        delta += 1
+        g = (g + g_odd * f) >> 1
+        e = (e + g_odd * d) % modulus
+        # halve e mod an odd modulus
+        e = (e + (e & 1) * modulus) >> 1
+    # f is now the gcd, which is 1 or -1 when num is invertible
+    return d * f % modulus
+
+
+def _pow_can_invert():
+    try:
+        return pow(2, -1, 3) == 2
+    except ValueError:
+        return False
+
+
+INVERSION_METHODS = {
+    'fermat': inverse_fermat,
+    'pow': inverse_pow,
+    'safegcd': inverse_safegcd,
+}
+# the fastest method available on this Python
+DEFAULT_INVERSION = 'pow' if _pow_can_invert() else 'fermat'
+
+
+def inverse(num, modulus, method=None):
+    '''Returns 1/num mod modulus using the named method from
+    INVERSION_METHODS, or the fastest one if method is None'''
+    if num % modulus == 0:
+        raise ZeroDivisionError('0 has no inverse mod {}'.format(modulus))
+    return INVERSION_METHODS[method or DEFAULT_INVERSION](num, modulus)
+
+
+class InverseTest(TestCase):
+
+    def test_methods(self):
+        for modulus in (31, 223, P, N):
+            for num in (1, 2, modulus - 1, randint(1, modulus - 1)):
+                for name in INVERSION_METHODS:
+                    if name == 'pow' and not _pow_can_invert():
+                        continue
+                    inv = inverse(num, modulus, method=name)
+                    self.assertEqual(num * inv % modulus, 1)
+        with self.assertRaises(ZeroDivisionError):
+            inverse(0, P)
+        with self.assertRaises(ZeroDivisionError):
+            inverse(N, N)
 
 
 class FieldElement:
+    __slots__ = ('num', 'prime')
 
     def __init__(self, num, prime):
         if num >= prime or num < 0:
@@ -71,7 +156,8 @@ class FieldElement:
         # self.num**(p-1) % p == 1
         # this means:
         # 1/n == pow(n, p-2, p)
-        num = (self.num * pow(other.num, self.prime - 2, self.prime)) % self.prime
+        # inverse() picks the fastest way to get 1/n
+        num = (self.num * inverse(other.num, self.prime)) % self.prime
         # We return an element of the same class
         return self.__class__(num, self.prime)
 
@@ -152,6 +238,18 @@ class Point:
             # if not, throw a ValueError
             raise ValueError('({}, {}) is not on the curve'.format(x, y))
 
+    @classmethod
+    def trusted(cls, x, y, a, b):
+        '''Creates a point without checking the curve equation. Only for
+        points that come out of the group law on points already known
+        to be on the curve.'''
+        point = cls.__new__(cls)
+        point.a = a
+        point.b = b
+        point.x = x
+        point.y = y
+        return point
+
     def __eq__(self, other):
         return self.x == other.x and self.y == other.y \
             and self.a == other.a and self.b == other.b
@@ -193,7 +291,8 @@ class Point:
             s = (other.y - self.y) / (other.x - self.x)
             x = s**2 - self.x - other.x
             y = s * (self.x - x) - self.y
-            return self.__class__(x, y, self.a, self.b)
+            # the sum of two points on the curve is on the curve
+            return self.trusted(x, y, self.a, self.b)
 
         # Case 4: if we are tangent to the vertical line,
         # we return the point at infinity
@@ -211,7 +310,7 @@ class Point:
             s = (3 * self.x**2 + self.a) / (2 * self.y)
             x = s**2 - 2 * self.x
             y = s * (self.x - x) - self.y
-            return self.__class__(x, y, self.a, self.b)
+            return self.trusted(x, y, self.a, self.b)
 
     def __rmul__(self, coefficient):
         coef = coefficient
@@ -257,6 +356,14 @@ class PointTest(TestCase):
         a = Point(x=-1, y=1, a=5, b=7)
         self.assertEqual(a + a, Point(x=18, y=-77, a=5, b=7))
 
+    def test_trusted(self):
+        # trusted skips the curve check, so only use it for derived points
+        a = Point.trusted(x=-2, y=4, a=5, b=7)
+        self.assertEqual((a.x, a.y, a.a, a.b), (-2, 4, 5, 7))
+        a = Point(x=3, y=7, a=5, b=7)
+        b = Point(x=-1, y=-1, a=5, b=7)
+        self.assertIsInstance(a + b, Point)
+
 
 class ECCTest(TestCase):
 
@@ -360,22 +467,435 @@ P = 2**256 - 2**32 - 977
 N = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
 
 
+# Jacobian coordinates: (X, Y, Z) represents the affine point (X/Z**2, Y/Z**3)
+# this lets us add and double without dividing, so the only inversion
+# needed for a whole scalar multiplication is the final one in to_affine.
+# all coordinates are plain integers mod P and Z == 0 is the point at infinity
+JACOBIAN_INFINITY = (0, 1, 0)
+
+
+def jacobian_double(p1):
+    '''Doubles a Jacobian point on y^2=x^3+7 (dbl-2009-l)'''
+    x1, y1, z1 = p1
+    if z1 == 0 or y1 == 0:
+        return JACOBIAN_INFINITY
+    a = x1 * x1 % P
+    b = y1 * y1 % P
+    c = b * b % P
+    d = 2 * ((x1 + b) ** 2 - a - c) % P
+    e = 3 * a % P
+    x3 = (e * e - 2 * d) % P
+    y3 = (e * (d - x3) - 8 * c) % P
+    z3 = 2 * y1 * z1 % P
+    return (x3, y3, z3)
+
+
+def jacobian_add(p1, p2):
+    '''Adds two Jacobian points (add-1998-cmo-2)'''
+    x1, y1, z1 = p1
+    x2, y2, z2 = p2
+    if z1 == 0:
+        return p2
+    if z2 == 0:
+        return p1
+    z1z1 = z1 * z1 % P
+    z2z2 = z2 * z2 % P
+    u1 = x1 * z2z2 % P
+    u2 = x2 * z1z1 % P
+    s1 = y1 * z2 * z2z2 % P
+    s2 = y2 * z1 * z1z1 % P
+    h = (u2 - u1) % P
+    r = (s2 - s1) % P
+    if h == 0:
+        # same x coordinate, so either the same point or its negation
+        if r == 0:
+            return jacobian_double(p1)
+        return JACOBIAN_INFINITY
+    hh = h * h % P
+    hhh = h * hh % P
+    v = u1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - s1 * hhh) % P
+    z3 = z1 * z2 * h % P
+    return (x3, y3, z3)
+
+
+def jacobian_add_affine(p1, x2, y2):
+    '''Adds a Jacobian point and an affine point (x2, y2), which is
+    cheaper than jacobian_add since Z2 is 1'''
+    x1, y1, z1 = p1
+    if z1 == 0:
+        return (x2, y2, 1)
+    z1z1 = z1 * z1 % P
+    u2 = x2 * z1z1 % P
+    s2 = y2 * z1 * z1z1 % P
+    h = (u2 - x1) % P
+    r = (s2 - y1) % P
+    if h == 0:
+        if r == 0:
+            return jacobian_double(p1)
+        return JACOBIAN_INFINITY
+    hh = h * h % P
+    hhh = h * hh % P
+    v = x1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - y1 * hhh) % P
+    z3 = z1 * h % P
+    return (x3, y3, z3)
+
+
+def jacobian_to_affine(p1):
+    '''Returns the affine (x, y) integers of a Jacobian point,
+    or None for the point at infinity'''
+    x1, y1, z1 = p1
+    if z1 == 0:
+        return None
+    # this is the one inversion
+    z_inv = field_inv(z1)
+    z_inv2 = z_inv * z_inv % P
+    return (x1 * z_inv2 % P, y1 * z_inv2 * z_inv % P)
+
+
+def jacobian_mul(coefficient, x, y):
+    '''Returns coefficient * (x, y) as a Jacobian point using
+    left-to-right double-and-add'''
+    result = JACOBIAN_INFINITY
+    for i in reversed(range(coefficient.bit_length())):
+        result = jacobian_double(result)
+        if (coefficient >> i) & 1:
+            result = jacobian_add_affine(result, x, y)
+    return result
+
+
+def jacobian_ladder(coefficient, bits, x, y, blind=1):
+    '''Montgomery ladder for coefficient * (x, y) going over exactly bits
+    bits, the top one of which has to be set. Every bit costs one addition
+    and one doubling and the bit only decides which slot of the pair gets
+    written, not what gets computed. blind randomizes the Jacobian
+    coordinates of the starting point.'''
+    blind2 = blind * blind % P
+    base = (x * blind2 % P, y * blind2 * blind % P, blind)
+    # invariant: pair[1] - pair[0] == (x, y)
+    pair = [base, jacobian_double(base)]
+    for i in reversed(range(bits - 1)):
+        bit = (coefficient >> i) & 1
+        pair[1 - bit] = jacobian_add(pair[0], pair[1])
+        pair[bit] = jacobian_double(pair[bit])
+    return pair[0]
+
+
+# hardened multiplications run the ladder on k + m*N for a random m
+# picked so that the blinded scalar always has exactly HARDENED_BITS bits
+HARDENED_BITS = 321
+HARDENED_M_MIN = -(-2**(HARDENED_BITS - 1) // N)
+HARDENED_M_MAX = (2**HARDENED_BITS - N) // N
+
+
+def hardened_g_mul(coefficient, rng=None):
+    '''Returns coefficient * G as a Jacobian point using the Montgomery
+    ladder with a blinded scalar and randomized coordinates. Much slower
+    than g_mul but the work done does not depend on the bits of the
+    coefficient. This is plain Python, so it narrows the timing side
+    channel rather than closing it.'''
+    if rng is None:
+        rng = SystemRandom()
+    m = rng.randint(HARDENED_M_MIN, HARDENED_M_MAX)
+    blinded = coefficient % N + m * N
+    return jacobian_ladder(
+        blinded, HARDENED_BITS, G.x.num, G.y.num, rng.randrange(1, P))
+
+
+def batch_inverse(values, modulus):
+    '''Inverts every (non-zero) value mod modulus with a single modular
+    inversion using Montgomery's simultaneous inversion trick'''
+    if len(values) == 0:
+        return []
+    # prefix[i] is the product of values[0..i]
+    prefix = []
+    acc = 1
+    for value in values:
+        acc = acc * value % modulus
+        prefix.append(acc)
+    # invert the product of everything once
+    inv = inverse(acc, modulus)
+    # walk backwards peeling off one value at a time
+    result = [0] * len(values)
+    for i in range(len(values) - 1, 0, -1):
+        result[i] = inv * prefix[i - 1] % modulus
+        inv = inv * values[i] % modulus
+    result[0] = inv
+    return result
+
+
+def jacobian_batch_to_affine(points):
+    '''Converts a list of finite Jacobian points to affine (x, y) integers
+    sharing one inversion between all of them'''
+    z_invs = batch_inverse([p[2] for p in points], P)
+    result = []
+    for (x1, y1, _), z_inv in zip(points, z_invs):
+        z_inv2 = z_inv * z_inv % P
+        result.append((x1 * z_inv2 % P, y1 * z_inv2 * z_inv % P))
+    return result
+
+
+# the generator table has one row per window of G_TABLE_WINDOW bits
+# and row i holds j * 2**(window*i) * G for j from 1 to 2**window - 1
+# a window of 6 bits is 43 rows of 63 points, which is a few hundred KB
+G_TABLE_WINDOW = 6
+_G_TABLE = None
+
+
+def set_g_table_window(window):
+    '''Changes the window size of the generator table, which gets
+    rebuilt the next time it is needed'''
+    global G_TABLE_WINDOW, _G_TABLE
+    if window < 1 or window > 16:
+        raise ValueError('window must be between 1 and 16 bits')
+    G_TABLE_WINDOW = window
+    _G_TABLE = None
+
+
+def g_table():
+    '''Returns the precomputed table of multiples of G, building it
+    on first use'''
+    global _G_TABLE
+    if _G_TABLE is None:
+        window = G_TABLE_WINDOW
+        size = 2**window - 1
+        rows = (N.bit_length() + window - 1) // window
+        points = []
+        base = (G.x.num, G.y.num, 1)
+        for _ in range(rows):
+            current = base
+            for _ in range(size):
+                points.append(current)
+                current = jacobian_add(current, base)
+            # the next row starts at 2**window times this row's base
+            base = current
+        affine = jacobian_batch_to_affine(points)
+        _G_TABLE = [affine[i:i + size] for i in range(0, len(affine), size)]
+    return _G_TABLE
+
+
+def g_mul(coefficient):
+    '''Returns coefficient * G as a Jacobian point using only additions
+    from the generator table'''
+    table = g_table()
+    window = G_TABLE_WINDOW
+    mask = 2**window - 1
+    result = JACOBIAN_INFINITY
+    for row in table:
+        digit = coefficient & mask
+        if digit:
+            result = jacobian_add_affine(result, *row[digit - 1])
+        coefficient >>= window
+    return result
+
+
+# window for the wNAF of variable base points: each point needs the
+# 2**(window-2) odd multiples P, 3P, 5P... precomputed
+WNAF_WINDOW = 5
+
+
+def wnaf(coefficient, window):
+    '''Returns the width-w non-adjacent form of coefficient, least
+    significant digit first. Every non-zero digit is odd and less than
+    2**(window-1) in absolute value.'''
+    digits = []
+    modulus = 2**window
+    half = 2**(window - 1)
+    while coefficient:
+        if coefficient & 1:
+            digit = coefficient % modulus
+            if digit >= half:
+                digit -= modulus
+            coefficient -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        coefficient >>= 1
+    return digits
+
+
+def odd_multiples(x, y, window):
+    '''Returns the affine points P, 3P, 5P, ... (2**(window-1)-1)P'''
+    current = (x, y, 1)
+    double = jacobian_double(current)
+    points = [current]
+    for _ in range(2**(window - 2) - 1):
+        current = jacobian_add(current, double)
+        points.append(current)
+    return jacobian_batch_to_affine(points)
+
+
+# secp256k1 has the endomorphism lambda * (x, y) == (beta * x, y)
+# which lets a 256-bit scalar k be split into k1 + k2 * lambda with
+# k1 and k2 around 128 bits each (Gallant-Lambert-Vanstone)
+GLV_BETA = 0x7ae96a2b657c07106e64479eac3434e99cf0497512f58995c1396c28719501ee
+GLV_LAMBDA = 0x5363ad4cc05c30e0a5261c028812645a122e22ea20816678df02967c1b23bd72
+# short basis (a1, b1), (a2, b2) of the lattice of (x, y) with
+# x + y * lambda == 0 mod N
+GLV_A1 = 0x3086d221a7d46bcde86c90e49284eb15
+GLV_B1 = -0xe4437ed6010e88286f547fa90abfe4c3
+GLV_A2 = 0x114ca50f7a8e2f3f657c1108d9d44cfd8
+GLV_B2 = 0x3086d221a7d46bcde86c90e49284eb15
+# whether variable base multiplications use the endomorphism by default
+USE_GLV = True
+
+
+def glv_split(coefficient):
+    '''Returns (k1, k2) with k1 + k2 * lambda == coefficient mod N.
+    k1 and k2 can be negative but are at most about 128 bits.'''
+    # round b2 * k / N and -b1 * k / N to the nearest integer
+    c1 = (GLV_B2 * coefficient + N // 2) // N
+    c2 = (-GLV_B1 * coefficient + N // 2) // N
+    k1 = coefficient - c1 * GLV_A1 - c2 * GLV_A2
+    k2 = -c1 * GLV_B1 - c2 * GLV_B2
+    return k1, k2
+
+
+def signed_wnaf(coefficient, window):
+    '''wNAF of a possibly negative coefficient'''
+    if coefficient < 0:
+        return [-digit for digit in wnaf(-coefficient, window)]
+    return wnaf(coefficient, window)
+
+
+def jacobian_multi_mul(scalars, points, glv=None):
+    '''Returns the sum of scalars[i] * points[i] as a Jacobian point.
+    Multiples of G are gathered into one lookup from the generator
+    table and the rest share one chain of doublings (Strauss-Shamir)
+    using a wNAF of each scalar. With glv, each of those scalars is
+    split in two halves so the chain is half as long.'''
+    if glv is None:
+        glv = USE_GLV
+    g_coef = 0
+    nafs = []
+    tables = []
+    for coef, point in zip(scalars, points):
+        coef = coef % N
+        if coef == 0 or point.x is None:
+            continue
+        if point.x.num == G.x.num and point.y.num == G.y.num:
+            g_coef += coef
+            continue
+        table = point.wnaf_table()
+        if glv:
+            k1, k2 = glv_split(coef)
+            nafs.append(signed_wnaf(k1, WNAF_WINDOW))
+            tables.append(table)
+            # the odd multiples of lambda * P are (beta * x, y)
+            nafs.append(signed_wnaf(k2, WNAF_WINDOW))
+            tables.append([(GLV_BETA * x % P, y) for x, y in table])
+        else:
+            nafs.append(wnaf(coef, WNAF_WINDOW))
+            tables.append(table)
+    result = JACOBIAN_INFINITY
+    length = max([len(naf) for naf in nafs], default=0)
+    for i in reversed(range(length)):
+        result = jacobian_double(result)
+        for naf, table in zip(nafs, tables):
+            if i >= len(naf) or naf[i] == 0:
+                continue
+            digit = naf[i]
+            if digit > 0:
+                x, y = table[digit // 2]
+                result = jacobian_add_affine(result, x, y)
+            else:
+                # subtracting is adding the negation (x, -y)
+                x, y = table[-digit // 2]
+                result = jacobian_add_affine(result, x, P - y)
+    if g_coef % N:
+        result = jacobian_add(result, g_mul(g_coef % N))
+    return result
+
+
+def jacobian_has_x(p1, x):
+    '''Returns whether the affine x coordinate of a Jacobian point is x.
+    X/Z**2 == x is checked as X == x*Z**2 so no inversion is needed.'''
+    x1, _, z1 = p1
+    if z1 == 0 or x >= P:
+        return False
+    return x * z1 * z1 % P == x1
+
+
+def multi_mul(scalars, points, glv=None):
+    '''Returns scalars[0] * points[0] + scalars[1] * points[1] + ...
+    as an S256Point, computed in one pass'''
+    if len(scalars) != len(points):
+        raise ValueError('need one scalar per point')
+    return S256Point.from_jacobian(jacobian_multi_mul(scalars, points, glv))
+
+
+def field_inv(num):
+    '''1/num mod P'''
+    return inverse(num, P)
+
+
+def field_sqrt(num):
+    '''Returns a square root of num mod P, since P % 4 == 3 this is
+    num**((P+1)/4). The result needs to be squared to check that num
+    actually has a square root.'''
+    return pow(num, (P + 1) // 4, P)
+
+
 class S256Field(FieldElement):
+    # secp256k1 field elements are always mod P, so the operators below
+    # work on the integers directly and skip the range check in __init__
+    __slots__ = ()
 
     def __init__(self, num, prime=None):
         super().__init__(num=num, prime=P)
 
+    @classmethod
+    def from_int(cls, num):
+        '''Wraps an integer that is already reduced mod P'''
+        element = object.__new__(cls)
+        element.num = num
+        element.prime = P
+        return element
+
     def __repr__(self):
         return '{:x}'.format(self.num).zfill(64)
 
+    def __add__(self, other):
+        if other.prime != P:
+            raise TypeError('Cannot add two numbers in different Fields')
+        return self.from_int((self.num + other.num) % P)
+
+    def __sub__(self, other):
+        if other.prime != P:
+            raise TypeError('Cannot subtract two numbers in different Fields')
+        return self.from_int((self.num - other.num) % P)
+
+    def __mul__(self, other):
+        if other.prime != P:
+            raise TypeError('Cannot multiply two numbers in different Fields')
+        return self.from_int(self.num * other.num % P)
+
+    def __pow__(self, exponent):
+        return self.from_int(pow(self.num, exponent % (P - 1), P))
+
+    def __truediv__(self, other):
+        if other.prime != P:
+            raise TypeError('Cannot divide two numbers in different Fields')
+        return self.from_int(self.num * field_inv(other.num) % P)
+
+    def __rmul__(self, coefficient):
+        return self.from_int(self.num * coefficient % P)
+
     def sqrt(self):
-        return self**((P + 1) // 4)
+        return self.from_int(field_sqrt(self.num))
+
+
+S256_A = S256Field(A)
+S256_B = S256Field(B)
 
 
 class S256Point(Point):
 
     def __init__(self, x, y, a=None, b=None):
-        a, b = S256Field(A), S256Field(B)
+        a, b = S256_A, S256_B
         if type(x) == int:
             super().__init__(x=S256Field(x), y=S256Field(y), a=a, b=b)
         else:
@@ -388,19 +908,84 @@ class S256Point(Point):
             return 'S256Point({}, {})'.format(self.x, self.y)
 
     def __rmul__(self, coefficient):
-        coef = coefficient % N
-        return super().__rmul__(coef)
+        # multiples of G come from the precomputed table, everything
+        # else from the wNAF
+        return self.from_jacobian(jacobian_multi_mul([coefficient], [self]))
+
+    @classmethod
+    def from_jacobian(cls, p):
+        '''Converts a Jacobian point back to an S256Point'''
+        affine = jacobian_to_affine(p)
+        if affine is None:
+            return cls(None, None)
+        x, y = affine
+        return cls.trusted(
+            S256Field.from_int(x), S256Field.from_int(y), S256_A, S256_B)
 
     def verify(self, z, sig):
-        # By Fermat's Little Theorem, 1/s = pow(s, N-2, N)
-        s_inv = pow(sig.s, N - 2, N)
+        # s must be invertible, 1/s = pow(s, N-2, N)
+        if sig.s % N == 0:
+            return False
+        s_inv = inverse(sig.s, N)
         # u = z / s
         u = z * s_inv % N
         # v = r / s
         v = sig.r * s_inv % N
         # u*G + v*P should have as the x coordinate, r
-        total = u * G + v * self
-        return total.x.num == sig.r
+        # we stay in Jacobian coordinates until the very end
+        total = jacobian_multi_mul([u, v], [G, self])
+        return jacobian_has_x(total, sig.r)
+
+    def verify_schnorr(self, msg, sig):
+        '''BIP340 verification of a SchnorrSignature of the bytes msg.
+        Only the x coordinate of this point is used, as if it had an
+        even y.'''
+        if sig.r >= P or sig.s >= N:
+            return False
+        e = sig.challenge(self.xonly(), msg)
+        # R = s*G - e*P where P is the even y point with our x
+        if self.y.num & 1 == 0:
+            e = N - e
+        total = jacobian_multi_mul([sig.s, e], [G, self])
+        affine = jacobian_to_affine(total)
+        if affine is None:
+            return False
+        x, y = affine
+        return x == sig.r and y & 1 == 0
+
+    def xonly(self):
+        '''32 byte x-only serialization from BIP340'''
+        return self.x.num.to_bytes(32, 'big')
+
+    @classmethod
+    def lift_x(cls, x):
+        '''Returns the point with x coordinate x and an even y'''
+        if x >= P:
+            raise ValueError('x is not a field element')
+        alpha = (pow(x, 3, P) + B) % P
+        y = field_sqrt(alpha)
+        if y * y % P != alpha:
+            raise ValueError('no point with x = {:x}'.format(x))
+        if y & 1:
+            y = P - y
+        return cls.trusted(
+            S256Field.from_int(x), S256Field.from_int(y), S256_A, S256_B)
+
+    @classmethod
+    def parse_xonly(cls, xonly_bin):
+        '''Returns the point for a 32 byte x-only public key'''
+        if len(xonly_bin) != 32:
+            raise ValueError('x-only keys are 32 bytes')
+        return cls.lift_x(int.from_bytes(xonly_bin, 'big'))
+
+    def wnaf_table(self):
+        '''Returns the odd multiples of this point used by multi_mul,
+        computing them the first time they are asked for'''
+        table = getattr(self, '_wnaf_table', None)
+        if table is None:
+            table = odd_multiples(self.x.num, self.y.num, WNAF_WINDOW)
+            self._wnaf_table = table
+        return table
 
     def sec(self, compressed=True):
         '''returns the binary version of the SEC format'''
@@ -430,28 +1015,68 @@ class S256Point(Point):
         return encode_base58_checksum(prefix + h160)
 
     @classmethod
-    def parse(self, sec_bin):
+    def from_ints(cls, x, y):
+        '''Creates a point from integer coordinates, checking the curve
+        equation directly on the integers'''
+        if x >= P or y >= P or x < 0 or y < 0:
+            raise ValueError('coordinates not in field range 0 to {}'.format(P - 1))
+        if (y * y - x * x * x - B) % P != 0:
+            raise ValueError('({:x}, {:x}) is not on the curve'.format(x, y))
+        return cls.trusted(
+            S256Field.from_int(x), S256Field.from_int(y), S256_A, S256_B)
+
+    @classmethod
+    def parse(cls, sec_bin):
         '''returns a Point object from a SEC binary (not hex)'''
         if sec_bin[0] == 4:
+            if len(sec_bin) != 65:
+                raise ValueError('uncompressed SEC must be 65 bytes')
             x = int.from_bytes(sec_bin[1:33], 'big')
             y = int.from_bytes(sec_bin[33:65], 'big')
-            return S256Point(x=x, y=y)
+            return cls.from_ints(x, y)
+        if sec_bin[0] not in (2, 3):
+            raise ValueError('unknown SEC prefix {}'.format(sec_bin[0]))
+        if len(sec_bin) != 33:
+            raise ValueError('compressed SEC must be 33 bytes')
         is_even = sec_bin[0] == 2
-        x = S256Field(int.from_bytes(sec_bin[1:], 'big'))
+        x = int.from_bytes(sec_bin[1:], 'big')
+        if x >= P:
+            raise ValueError('x not in field range 0 to {}'.format(P - 1))
         # right side of the equation y^2 = x^3 + 7
-        alpha = x**3 + S256Field(B)
+        alpha = (x * x * x + B) % P
         # solve for left side
-        beta = alpha.sqrt()
-        if beta.num % 2 == 0:
+        beta = field_sqrt(alpha)
+        # not every number has a square root, so check
+        if beta * beta % P != alpha:
+            raise ValueError('{:x} is not the x of a point on the curve'.format(x))
+        if beta % 2 == 0:
             even_beta = beta
-            odd_beta = S256Field(P - beta.num)
+            odd_beta = P - beta
         else:
-            even_beta = S256Field(P - beta.num)
+            even_beta = P - beta
             odd_beta = beta
+        # the square root makes the point valid, so we can trust it
         if is_even:
-            return S256Point(x, even_beta)
+            y = even_beta
         else:
-            return S256Point(x, odd_beta)
+            y = odd_beta
+        return cls.trusted(
+            S256Field.from_int(x), S256Field.from_int(y), S256_A, S256_B)
+
+    @classmethod
+    def parse_many(cls, sec_list):
+        '''Parses a list of SEC binaries, decompressing repeated keys
+        only once. Returns a list of points in the same order.'''
+        parsed = {}
+        result = []
+        for sec_bin in sec_list:
+            key = bytes(sec_bin)
+            point = parsed.get(key)
+            if point is None:
+                point = cls.parse(key)
+                parsed[key] = point
+            result.append(point)
+        return result
 
 
 G = S256Point(
@@ -459,8 +1084,128 @@ G = S256Point(
     0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8)
 
 
+def verify_batch(items):
+    '''Takes a list of (point, z, sig) and returns a list of whether
+    each signature is valid. The s inverses of every item come from a
+    single modular inversion and points that show up more than once share
+    their precomputed multiples.'''
+    results = [False] * len(items)
+    # signatures with s == 0 mod N can't be inverted and are never valid
+    todo = [i for i, (_, _, sig) in enumerate(items) if sig.s % N != 0]
+    s_invs = batch_inverse([items[i][2].s for i in todo], N)
+    # the same public key is often used by many inputs
+    points = {}
+    for i, s_inv in zip(todo, s_invs):
+        point, z, sig = items[i]
+        key = (point.x.num, point.y.num)
+        point = points.setdefault(key, point)
+        u = z * s_inv % N
+        v = sig.r * s_inv % N
+        total = jacobian_multi_mul([u, v], [G, point])
+        results[i] = jacobian_has_x(total, sig.r)
+    return results
+
+
+class PointCache:
+    '''Least recently used cache of parsed public keys keyed by their SEC
+    bytes. Each cached point keeps its wNAF table, so verifying against a
+    key we have seen before skips both the parsing and the precomputation.'''
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.points = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'PointCache({}/{}, hits={}, misses={})'.format(
+            len(self.points), self.capacity, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.points)
+
+    def parse(self, sec_bin):
+        '''Same as S256Point.parse, but served from the cache if possible'''
+        key = bytes(sec_bin)
+        point = self.points.get(key)
+        if point is not None:
+            self.hits += 1
+            # mark as the most recently used
+            self.points.move_to_end(key)
+            return point
+        self.misses += 1
+        point = S256Point.parse(key)
+        point.wnaf_table()
+        self.points[key] = point
+        # evict the least recently used points
+        while len(self.points) > self.capacity:
+            self.points.popitem(last=False)
+        return point
+
+    def resize(self, capacity):
+        '''Changes the capacity, evicting points if needed'''
+        self.capacity = capacity
+        while len(self.points) > capacity:
+            self.points.popitem(last=False)
+
+    def clear(self):
+        '''Empties the cache and resets the counters'''
+        self.points.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# process-wide cache used by op_checksig and op_checkmultisig
+POINT_CACHE = PointCache()
+
+
+class PointCacheTest(TestCase):
+
+    def test_parse(self):
+        cache = PointCache(capacity=2)
+        secs = [(secret * G).sec() for secret in (1, 2, 3)]
+        point = cache.parse(secs[0])
+        self.assertEqual(point, G)
+        self.assertIs(cache.parse(secs[0]), point)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # the wNAF table comes along with the cached point
+        self.assertIsNotNone(point._wnaf_table)
+        cache.parse(secs[1])
+        cache.parse(secs[0])
+        # secs[1] is the least recently used so it gets evicted
+        cache.parse(secs[2])
+        self.assertEqual(len(cache), 2)
+        self.assertIn(secs[0], cache.points)
+        self.assertNotIn(secs[1], cache.points)
+        cache.resize(1)
+        self.assertEqual(list(cache.points), [secs[2]])
+        cache.clear()
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+        with self.assertRaises(ValueError):
+            cache.parse(b'\x04' + b'\x00' * 64)
+
+
 class S256Test(TestCase):
 
+    def test_field(self):
+        a = S256Field(P - 2)
+        b = S256Field(12345)
+        generic_a = FieldElement(P - 2, P)
+        generic_b = FieldElement(12345, P)
+        self.assertEqual((a + b).num, (generic_a + generic_b).num)
+        self.assertEqual((a - b).num, (generic_a - generic_b).num)
+        self.assertEqual((b - a).num, (generic_b - generic_a).num)
+        self.assertEqual((a * b).num, (generic_a * generic_b).num)
+        self.assertEqual((a / b).num, (generic_a / generic_b).num)
+        self.assertEqual((a**-3).num, (generic_a**-3).num)
+        self.assertEqual((3 * a).num, (3 * generic_a).num)
+        self.assertIsInstance(a + b, S256Field)
+        self.assertEqual(S256Field(4).sqrt()**2, S256Field(4))
+        with self.assertRaises(TypeError):
+            a + FieldElement(2, 31)
+        with self.assertRaises(ValueError):
+            S256Field(P)
+
     def test_order(self):
         point = N * G
         self.assertIsNone(point.x)
@@ -482,6 +1227,73 @@ class S256Test(TestCase):
             # check that the secret*G is the same as the point
             self.assertEqual(secret * G, point)
 
+    def test_jacobian(self):
+        # compare against the affine double-and-add from Point
+        for secret in (1, 2, 3, 2**128 + 1, N - 1, randint(1, N)):
+            want = Point.__rmul__(G, secret)
+            self.assertEqual(secret * G, want)
+        # P + P, P + -P and P + infinity
+        g = (G.x.num, G.y.num, 1)
+        neg_g = (G.x.num, P - G.y.num, 1)
+        self.assertEqual(S256Point.from_jacobian(jacobian_add(g, g)), 2 * G)
+        self.assertIsNone(S256Point.from_jacobian(jacobian_add(g, neg_g)).x)
+        self.assertEqual(S256Point.from_jacobian(jacobian_add(g, JACOBIAN_INFINITY)), G)
+        self.assertIsNone((0 * G).x)
+
+    def test_g_table(self):
+        secrets = (1, 2, 63, 64, 2**255, N - 1, randint(1, N))
+        try:
+            for window in (1, 4, 8):
+                set_g_table_window(window)
+                for secret in secrets:
+                    want = S256Point.from_jacobian(
+                        jacobian_mul(secret, G.x.num, G.y.num))
+                    self.assertEqual(secret * G, want)
+        finally:
+            set_g_table_window(6)
+        with self.assertRaises(ValueError):
+            set_g_table_window(0)
+
+    def test_wnaf(self):
+        for coef in (1, 7, 2**200 - 1, randint(1, N)):
+            naf = wnaf(coef, 5)
+            self.assertEqual(sum(d * 2**i for i, d in enumerate(naf)), coef)
+            for d in naf:
+                self.assertTrue(d == 0 or (d % 2 == 1 and abs(d) < 16))
+
+    def test_multi_mul(self):
+        p1 = 12345 * G
+        p2 = randint(1, N) * G
+        scalars = [randint(1, N), randint(1, N), randint(1, N), 3]
+        points = [G, p1, p2, G]
+        want = scalars[0] * G + scalars[1] * p1 + scalars[2] * p2 + 3 * G
+        self.assertEqual(multi_mul(scalars, points), want)
+        # p + -p is the point at infinity
+        self.assertIsNone(multi_mul([5, N - 5], [p1, p1]).x)
+        self.assertIsNone(multi_mul([], []).x)
+        with self.assertRaises(ValueError):
+            multi_mul([1], [])
+
+    def test_glv(self):
+        self.assertEqual(GLV_LAMBDA * G, S256Point(GLV_BETA * G.x.num % P, G.y.num))
+        for coef in (1, N - 1, 2**255, randint(1, N)):
+            k1, k2 = glv_split(coef)
+            self.assertEqual((k1 + k2 * GLV_LAMBDA) % N, coef)
+            self.assertLessEqual(abs(k1).bit_length(), 129)
+            self.assertLessEqual(abs(k2).bit_length(), 129)
+        point = randint(1, N) * G
+        scalars = [randint(1, N), randint(1, N)]
+        self.assertEqual(
+            multi_mul(scalars, [G, point], glv=True),
+            multi_mul(scalars, [G, point], glv=False))
+        self.assertIsNone(multi_mul([7, N - 7], [point, point], glv=True).x)
+
+    def test_batch_inverse(self):
+        values = [randint(1, N - 1) for _ in range(10)]
+        for value, inv in zip(values, batch_inverse(values, N)):
+            self.assertEqual(value * inv % N, 1)
+        self.assertEqual(batch_inverse([], N), [])
+
     def test_verify(self):
         point = S256Point(
             0x887387e452b8eacc4acfde10d9aaf7f6d9a0f975aabb10d006e4da568744d06c,
@@ -495,6 +1307,22 @@ class S256Test(TestCase):
         s = 0xc7207fee197d27c618aea621406f6bf5ef6fca38681d82b2f06fddbdce6feab6
         self.assertTrue(point.verify(z, Signature(r, s)))
 
+    def test_verify_batch(self):
+        items = []
+        for secret in (1, 2, 3):
+            pk = PrivateKey(secret)
+            for z in (randint(0, 2**256), randint(0, 2**256)):
+                items.append((pk.point, z, pk.sign(z)))
+        want = [True] * len(items)
+        # wrong z, wrong key and an s of 0
+        point, z, sig = items[0]
+        items.append((point, z + 1, sig))
+        items.append((items[2][0], z, sig))
+        items.append((point, z, Signature(sig.r, 0)))
+        want += [False, False, False]
+        self.assertEqual(verify_batch(items), want)
+        self.assertEqual(verify_batch([]), [])
+
     def test_sec(self):
         coefficient = 999**3
         uncompressed = '049d5ca49670cbe4c3bfa84c96a8c87df086c6ea6a24ba6b809c9de234496808d56fa15cc7f3d38cda98dee2419f415b7513dde1301f8643cd9245aea7f3f911f9'
@@ -515,6 +1343,33 @@ class S256Test(TestCase):
         self.assertEqual(point.sec(compressed=False), bytes.fromhex(uncompressed))
         self.assertEqual(point.sec(compressed=True), bytes.fromhex(compressed))
 
+    def test_parse(self):
+        for secret in (1, 999**3, 123, 42424242, randint(1, N)):
+            point = secret * G
+            self.assertEqual(S256Point.parse(point.sec(compressed=True)), point)
+            self.assertEqual(S256Point.parse(point.sec(compressed=False)), point)
+        bad = (
+            # x = 5 is not on the curve
+            b'\x02' + (5).to_bytes(32, 'big'),
+            # y is off by one
+            b'\x04' + G.x.num.to_bytes(32, 'big') + (G.y.num + 1).to_bytes(32, 'big'),
+            # x >= P
+            b'\x02' + (P + 1).to_bytes(32, 'big'),
+            # bad prefix and bad lengths
+            b'\x05' + G.x.num.to_bytes(32, 'big'),
+            G.sec()[:-1],
+            G.sec(compressed=False)[:-1],
+        )
+        for sec in bad:
+            with self.assertRaises(ValueError):
+                S256Point.parse(sec)
+
+    def test_parse_many(self):
+        points = [G, 2 * G, G, 3 * G]
+        secs = [points[0].sec(), points[1].sec(compressed=False),
+                points[2].sec(), points[3].sec()]
+        self.assertEqual(S256Point.parse_many(secs), points)
+
     def test_address(self):
         secret = 888**3
         mainnet_address = '148dY81A9BmdpMhvYEVznrM45kWN32vSCN'
@@ -544,52 +1399,117 @@ class S256Test(TestCase):
 
 class Signature:
 
-    def __init__(self, r, s):
+    def __init__(self, r, s, recid=None):
         self.r = r
         self.s = s
+        # recovery id: bit 0 is the parity of the y of k*G and bit 1 is
+        # set when the x of k*G was N or more, so r is x - N
+        self.recid = recid
 
     def __repr__(self):
         return 'Signature({:x},{:x})'.format(self.r, self.s)
 
     def der(self):
-        rbin = self.r.to_bytes(32, byteorder='big')
-        # remove all null bytes at the beginning
-        rbin = rbin.lstrip(b'\x00')
-        # if rbin has a high bit, add a \x00
-        if rbin[0] & 0x80:
-            rbin = b'\x00' + rbin
-        result = bytes([2, len(rbin)]) + rbin  # <1>
-        sbin = self.s.to_bytes(32, byteorder='big')
-        # remove all null bytes at the beginning
-        sbin = sbin.lstrip(b'\x00')
-        # if sbin has a high bit, add a \x00
-        if sbin[0] & 0x80:
-            sbin = b'\x00' + sbin
-        result += bytes([2, len(sbin)]) + sbin
-        return bytes([0x30, len(result)]) + result
+        # minimal big endian bytes, with a \x00 in front if the high bit is set
+        rbin = der_integer(self.r)
+        sbin = der_integer(self.s)
+        length = len(rbin) + len(sbin) + 4
+        return b''.join((
+            bytes((0x30, length, 2, len(rbin))), rbin,
+            bytes((2, len(sbin))), sbin))
 
     @classmethod
-    def parse(cls, signature_bin):
-        s = BytesIO(signature_bin)
-        compound = s.read(1)[0]
-        if compound != 0x30:
+    def parse(cls, signature_bin, strict=False):
+        '''Parses a DER signature without the hash type. signature_bin can
+        be any bytes-like object, a memoryview slice of a larger buffer is
+        read in place. With strict, the BIP66 encoding rules are enforced.'''
+        sig = signature_bin
+        total = len(sig)
+        if total < 6 or (strict and (total < 8 or total > 72)):
+            raise SyntaxError("Bad Signature Length")
+        if sig[0] != 0x30:
             raise SyntaxError("Bad Signature")
-        length = s.read(1)[0]
-        if length + 2 != len(signature_bin):
+        if sig[1] + 2 != total:
             raise SyntaxError("Bad Signature Length")
-        marker = s.read(1)[0]
-        if marker != 0x02:
+        if sig[2] != 0x02:
             raise SyntaxError("Bad Signature")
-        rlength = s.read(1)[0]
-        r = int.from_bytes(s.read(rlength), 'big')
-        marker = s.read(1)[0]
-        if marker != 0x02:
+        rlength = sig[3]
+        # the s marker and length come right after r
+        if rlength + 6 > total:
+            raise SyntaxError("Bad Signature Length")
+        if sig[4 + rlength] != 0x02:
             raise SyntaxError("Bad Signature")
-        slength = s.read(1)[0]
-        s = int.from_bytes(s.read(slength), 'big')
-        if len(signature_bin) != 6 + rlength + slength:
+        slength = sig[5 + rlength]
+        if total != 6 + rlength + slength:
             raise SyntaxError("Signature too long")
-        return cls(r, s)
+        rbin = sig[4:4 + rlength]
+        sbin = sig[6 + rlength:total]
+        if strict:
+            check_der_integer(rbin)
+            check_der_integer(sbin)
+        return cls(int.from_bytes(rbin, 'big'), int.from_bytes(sbin, 'big'))
+
+    def compact(self, compressed=True):
+        '''65 byte recoverable signature: a header byte of 27 + recid
+        (+ 4 if the key is compressed) followed by r and s'''
+        if self.recid is None:
+            raise ValueError('signature has no recovery id')
+        header = 27 + self.recid + (4 if compressed else 0)
+        return bytes([header]) + self.r.to_bytes(32, 'big') + \
+            self.s.to_bytes(32, 'big')
+
+    @classmethod
+    def parse_compact(cls, compact_bin):
+        '''Parses a 65 byte recoverable signature.
+        Returns the Signature and whether the key is compressed'''
+        if len(compact_bin) != 65:
+            raise SyntaxError('Bad Signature Length')
+        header = compact_bin[0]
+        if header < 27 or header > 34:
+            raise SyntaxError('Bad Signature Header')
+        compressed = header >= 31
+        recid = (header - 27) & 3
+        r = int.from_bytes(compact_bin[1:33], 'big')
+        s = int.from_bytes(compact_bin[33:65], 'big')
+        return cls(r, s, recid), compressed
+
+    def recover(self, z, recid=None):
+        '''Returns the public key (S256Point) that made this signature of z.
+        Uses self.recid if no recid is given.'''
+        if recid is None:
+            recid = self.recid
+        if recid is None or recid < 0 or recid > 3:
+            raise ValueError('need a recovery id between 0 and 3')
+        if self.r % N == 0 or self.s % N == 0:
+            raise ValueError('r and s must be non-zero')
+        # rebuild R = k*G from its x coordinate and the parity of y
+        x = self.r + (recid >> 1) * N
+        if x >= P:
+            raise ValueError('no point with x = {:x}'.format(x))
+        point = S256Point.parse(bytes([2 + (recid & 1)]) + x.to_bytes(32, 'big'))
+        # s*k == z + r*secret, so secret*G == (s*R - z*G) / r
+        r_inv = inverse(self.r, N)
+        public_key = multi_mul([-z * r_inv, self.s * r_inv], [G, point])
+        if public_key.x is None:
+            raise ValueError('recovered the point at infinity')
+        return public_key
+
+
+def der_integer(num):
+    '''Minimal big endian encoding of a non-negative DER integer'''
+    # one more byte than needed for the bits, which is the \x00 pad
+    # exactly when the high bit of the top byte would be set
+    return num.to_bytes(num.bit_length() // 8 + 1, 'big')
+
+
+def check_der_integer(num_bin):
+    '''Raises SyntaxError unless num_bin is a BIP66 strict DER integer'''
+    if len(num_bin) == 0:
+        raise SyntaxError("Bad Signature: empty integer")
+    if num_bin[0] & 0x80:
+        raise SyntaxError("Bad Signature: negative integer")
+    if len(num_bin) > 1 and num_bin[0] == 0 and not num_bin[1] & 0x80:
+        raise SyntaxError("Bad Signature: excess padding")
 
 
 class SignatureTest(TestCase):
@@ -606,50 +1526,332 @@ class SignatureTest(TestCase):
             sig2 = Signature.parse(der)
             self.assertEqual(sig2.r, r)
             self.assertEqual(sig2.s, s)
+            sig3 = Signature.parse(der, strict=True)
+            self.assertEqual((sig3.r, sig3.s), (r, s))
+
+    def test_parse_view(self):
+        der = bytes.fromhex('3045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed')
+        # the signature in the middle of a bigger buffer with the hash type
+        buf = memoryview(b'\x48' + der + b'\x01')
+        sig = Signature.parse(buf[1:-1], strict=True)
+        self.assertEqual(sig.der(), der)
+
+    def test_recover(self):
+        for secret in (1, 12345, randint(1, N)):
+            pk = PrivateKey(secret)
+            for z in (randint(0, 2**256), randint(0, 2**256)):
+                sig = pk.sign(z)
+                self.assertEqual(sig.recover(z), pk.point)
+                for compressed in (True, False):
+                    compact = sig.compact(compressed)
+                    self.assertEqual(len(compact), 65)
+                    sig2, got = Signature.parse_compact(compact)
+                    self.assertEqual(got, compressed)
+                    self.assertEqual(sig2.recover(z), pk.point)
+                # the other parity gives some other key
+                self.assertNotEqual(sig.recover(z, sig.recid ^ 1), pk.point)
+        pk = PrivateKey(randint(1, N))
+        for z, sig in zip([1, 2], pk.sign_many([1, 2])):
+            self.assertEqual(sig.recover(z), pk.point)
+        hardened = PrivateKey(pk.secret, hardened=True)
+        self.assertEqual(hardened.sign(3).recover(3), pk.point)
+        other = PrivateKey(randint(1, N))
+        items = [(pk, 4), (other, 5)]
+        for (key, z), sig in zip(items, sign_batch(items)):
+            self.assertEqual(sig.recover(z), key.point)
+        with self.assertRaises(ValueError):
+            Signature(1, 2).recover(3)
+        with self.assertRaises(ValueError):
+            Signature(1, 2).compact()
+        with self.assertRaises(SyntaxError):
+            Signature.parse_compact(b'\x1a' + b'\x01' * 64)
+
+    def test_parse_strict(self):
+        bad = (
+            # r is negative
+            '3006020180020101',
+            # r has an unneeded leading zero
+            '300702020001020101',
+            # r is empty
+            '3006020002020101',
+        )
+        for der in bad:
+            sig_bin = bytes.fromhex(der)
+            # the lenient parser takes these
+            Signature.parse(sig_bin)
+            with self.assertRaises(SyntaxError):
+                Signature.parse(sig_bin, strict=True)
+        broken = (
+            # wrong compound marker, length, r marker, s marker, too short
+            '3106020101020101',
+            '3007020101020101',
+            '3006030101020101',
+            '3006020101030101',
+            '300402010102',
+            # r length runs past the end
+            '3006020501020101',
+        )
+        for der in broken:
+            with self.assertRaises(SyntaxError):
+                Signature.parse(bytes.fromhex(der))
+
+
+class SchnorrSignature:
+
+    def __init__(self, r, s):
+        # r is the x coordinate of R, which always has an even y
+        self.r = r
+        self.s = s
+
+    def __repr__(self):
+        return 'SchnorrSignature({:x},{:x})'.format(self.r, self.s)
+
+    def serialize(self):
+        '''64 bytes, x(R) followed by s'''
+        return self.r.to_bytes(32, 'big') + self.s.to_bytes(32, 'big')
+
+    @classmethod
+    def parse(cls, signature_bin):
+        if len(signature_bin) != 64:
+            raise SyntaxError('Bad Signature Length')
+        r = int.from_bytes(signature_bin[:32], 'big')
+        s = int.from_bytes(signature_bin[32:], 'big')
+        return cls(r, s)
+
+    def challenge(self, xonly, msg):
+        '''e = hash(x(R) || x(P) || msg) mod N'''
+        e = tagged_hash(
+            'BIP0340/challenge', self.r.to_bytes(32, 'big') + xonly + msg)
+        return int.from_bytes(e, 'big') % N
+
+
+def verify_schnorr_batch(items, rng=None):
+    '''Takes a list of (point, msg, sig) and returns whether every
+    signature is valid. Each equation s*G == R + e*P is multiplied by a
+    random 128 bit a (the first by 1) and all of them are added up, so
+    the whole batch is checked by a single multi-scalar multiplication:
+    (sum a*s)*G - sum a*R - sum a*e*P == infinity
+    A batch with a bad signature passes with probability about 2**-128.'''
+    if rng is None:
+        rng = SystemRandom()
+    g_coef = 0
+    scalars = []
+    points = []
+    # the same public key is often used by many inputs
+    keys = {}
+    for i, (point, msg, sig) in enumerate(items):
+        if sig.r >= P or sig.s >= N:
+            return False
+        try:
+            big_r = S256Point.lift_x(sig.r)
+        except ValueError:
+            return False
+        a = 1 if i == 0 else rng.randrange(1, 2**128)
+        e = sig.challenge(point.xonly(), msg)
+        g_coef += a * sig.s
+        # a*(-R) keeps the scalar at 128 bits where N - a would not
+        scalars.append(a)
+        points.append(S256Point.trusted(
+            big_r.x, S256Field.from_int(P - big_r.y.num), S256_A, S256_B))
+        # -a*e*P for the even y point with P's x, an odd y point and its
+        # even twin are the same x-only key so they share a coefficient
+        coef = N - a * e % N
+        key = point.x.num
+        if key in keys:
+            keys[key] = (keys[key][0], keys[key][1] + coef)
+        else:
+            if point.y.num & 1:
+                point = S256Point.trusted(
+                    point.x, S256Field.from_int(P - point.y.num),
+                    S256_A, S256_B)
+            keys[key] = (point, coef)
+    for point, coef in keys.values():
+        scalars.append(coef)
+        points.append(point)
+    scalars.append(g_coef)
+    points.append(G)
+    return jacobian_multi_mul(scalars, points)[2] == 0
+
+
+class SchnorrTest(TestCase):
+
+    def test_bip340_vector(self):
+        # test vector 0 from BIP340
+        pk = PrivateKey(3)
+        want_key = bytes.fromhex('F9308A019258C31049344F85F89D5229B531C845836F99B08601F113BCE036F9')
+        want_sig = bytes.fromhex('E907831F80848D1069A5371B402410364BDF1C5F8307B0084C55F1CE2DCA821525F66A4A85EA8B71E482A74F382D2CE5EBEEE8FDB2172F477DF4900D310536C0')
+        msg = bytes(32)
+        self.assertEqual(pk.point.xonly(), want_key)
+        sig = pk.sign_schnorr(msg, aux_rand=bytes(32))
+        self.assertEqual(sig.serialize(), want_sig)
+        point = S256Point.parse_xonly(want_key)
+        self.assertTrue(point.verify_schnorr(msg, SchnorrSignature.parse(want_sig)))
+
+    def test_sign_verify(self):
+        for secret in (1, 2, randint(1, N), randint(1, N)):
+            pk = PrivateKey(secret)
+            msg = randint(0, 2**256).to_bytes(32, 'big')
+            sig = pk.sign_schnorr(msg)
+            # odd and even y keys both verify with their x-only key
+            self.assertTrue(pk.point.verify_schnorr(msg, sig))
+            point = S256Point.parse_xonly(pk.point.xonly())
+            self.assertTrue(point.verify_schnorr(msg, sig))
+            self.assertFalse(pk.point.verify_schnorr(msg[::-1], sig))
+            self.assertFalse(pk.point.verify_schnorr(
+                msg, SchnorrSignature(sig.r, (sig.s + 1) % N)))
+        hardened = PrivateKey(secret, hardened=True)
+        self.assertEqual(
+            hardened.sign_schnorr(msg, bytes(32)).serialize(),
+            pk.sign_schnorr(msg, bytes(32)).serialize())
+        with self.assertRaises(ValueError):
+            S256Point.lift_x(5)
+
+    def test_verify_batch(self):
+        items = []
+        for secret in (1, 2, 3, randint(1, N)):
+            pk = PrivateKey(secret)
+            for msg in (b'a' * 32, b'b' * 32):
+                items.append((pk.point, msg, pk.sign_schnorr(msg)))
+        self.assertTrue(verify_schnorr_batch(items))
+        self.assertTrue(verify_schnorr_batch([]))
+        point, msg, sig = items[-1]
+        bad = SchnorrSignature(sig.r, (sig.s + 1) % N)
+        self.assertFalse(verify_schnorr_batch(items + [(point, msg, bad)]))
+        self.assertFalse(verify_schnorr_batch(items + [(items[0][0], msg, sig)]))
+        bad = SchnorrSignature(5, sig.s)
+        self.assertFalse(verify_schnorr_batch(items + [(point, msg, bad)]))
+        # the same x-only key as an odd y point and as its even twin
+        pk = PrivateKey(3)
+        while not pk.point.y.num & 1:
+            pk = PrivateKey(pk.secret + 1)
+        even = S256Point.parse_xonly(pk.point.xonly())
+        mixed = []
+        for point in (pk.point, even):
+            msg = randint(0, 2**256).to_bytes(32, 'big')
+            sig = pk.sign_schnorr(msg)
+            self.assertTrue(point.verify_schnorr(msg, sig))
+            mixed.append((point, msg, sig))
+        self.assertTrue(verify_schnorr_batch(mixed))
+        self.assertTrue(verify_schnorr_batch(mixed[::-1]))
+        self.assertTrue(verify_schnorr_batch(items + mixed))
 
 
 class PrivateKey:
 
-    def __init__(self, secret):
+    def __init__(self, secret, hardened=False):
         self.secret = secret
-        self.point = secret * G
+        # hardened keys use the slower constant work code for everything
+        # that touches the secret or the nonce
+        self.hardened = hardened
+        if hardened:
+            self.point = S256Point.from_jacobian(hardened_g_mul(secret))
+        else:
+            self.point = secret * G
 
     def hex(self):
         return '{:x}'.format(self.secret).zfill(64)
 
     def sign(self, z):
+        if self.hardened:
+            return self.sign_hardened(z)
         k = self.deterministic_k(z)
         # r is the x coordinate of the resulting point k*G
-        r = (k * G).x.num
+        point = k * G
+        r = point.x.num
+        # the recovery id remembers which y goes with r
+        recid = point.y.num & 1
         # remember 1/k = pow(k, N-2, N)
-        k_inv = pow(k, N - 2, N)
+        k_inv = inverse(k, N)
         # s = (z+r*secret) / k
         s = (z + r * self.secret) * k_inv % N
-        if s > N / 2:
+        if s > N // 2:
+            # -s goes with -k*G, which has the other y
             s = N - s
+            recid ^= 1
         # return an instance of Signature:
         # Signature(r, s)
-        return Signature(r, s)
+        return Signature(r, s, recid)
+
+    def sign_hardened(self, z):
+        '''Same signature as sign, but k*G uses the blinded ladder and
+        1/k is computed as b/(k*b) for a random b with safegcd'''
+        rng = SystemRandom()
+        k = self.deterministic_k(z)
+        r, y = jacobian_to_affine(hardened_g_mul(k, rng))
+        recid = y & 1
+        blind = rng.randrange(1, N)
+        k_inv = inverse(k * blind % N, N, method='safegcd') * blind % N
+        s = (z + r * self.secret) * k_inv % N
+        if s > N // 2:
+            s = N - s
+            recid ^= 1
+        return Signature(r, s, recid)
+
+    def sign_schnorr(self, msg, aux_rand=None):
+        '''BIP340 signature of the bytes msg. aux_rand is 32 bytes of
+        fresh randomness mixed into the nonce, a random one is used when
+        it is not given.'''
+        if aux_rand is None:
+            aux_rand = SystemRandom().getrandbits(256).to_bytes(32, 'big')
+        # the x-only key stands for the point with an even y
+        secret = self.secret
+        if self.point.y.num & 1:
+            secret = N - secret
+        xonly = self.point.xonly()
+        t = secret ^ int.from_bytes(tagged_hash('BIP0340/aux', aux_rand), 'big')
+        rand = tagged_hash('BIP0340/nonce', t.to_bytes(32, 'big') + xonly + msg)
+        k = int.from_bytes(rand, 'big') % N
+        if k == 0:
+            raise RuntimeError('nonce is 0, try again with another aux_rand')
+        if self.hardened:
+            r, y = jacobian_to_affine(hardened_g_mul(k))
+        else:
+            r, y = jacobian_to_affine(g_mul(k))
+        if y & 1:
+            k = N - k
+        sig = SchnorrSignature(r, 0)
+        sig.s = (k + sig.challenge(xonly, msg) * secret) % N
+        return sig
+
+    def sign_many(self, zs):
+        '''Signs every z in zs, returns a list of Signatures'''
+        return sign_batch([(self, z) for z in zs])
+
+    def k_hmac(self):
+        '''The first HMAC of deterministic_k always uses the all zero key
+        and starts with v + b'\x00' + secret_bytes, so we feed that in once
+        and copy the HMAC for every z'''
+        h = getattr(self, '_k_hmac', None)
+        if h is None:
+            secret_bytes = self.secret.to_bytes(32, 'big')
+            h = hmac.new(b'\x00' * 32, b'\x01' * 32 + b'\x00' + secret_bytes,
+                         hashlib.sha256)
+            self._k_hmac = h
+        return h
 
     def deterministic_k(self, z):
-        k = b'\x00' * 32
         v = b'\x01' * 32
         if z > N:
             z -= N
         z_bytes = z.to_bytes(32, 'big')
         secret_bytes = self.secret.to_bytes(32, 'big')
         s256 = hashlib.sha256
-        k = hmac.new(k, v + b'\x00' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        k = hmac.new(k, v + b'\x01' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
+        # k = hmac(b'\x00' * 32, v + b'\x00' + secret_bytes + z_bytes)
+        k = hmac_digest(self.k_hmac(), z_bytes)
+        # every k gets used for more than one HMAC, so set up the key once
+        keyed = hmac.new(k, digestmod=s256)
+        v = hmac_digest(keyed, v)
+        k = hmac_digest(keyed, v + b'\x01' + secret_bytes + z_bytes)
+        keyed = hmac.new(k, digestmod=s256)
+        v = hmac_digest(keyed, v)
         while True:
-            v = hmac.new(k, v, s256).digest()
+            v = hmac_digest(keyed, v)
             candidate = int.from_bytes(v, 'big')
             if candidate >= 1 and candidate < N:
                 return candidate
-            k = hmac.new(k, v + b'\x00', s256).digest()
-            v = hmac.new(k, v, s256).digest()
+            k = hmac_digest(keyed, v + b'\x00')
+            keyed = hmac.new(k, digestmod=s256)
+            v = hmac_digest(keyed, v)
 
     def wif(self, compressed=True, testnet=False):
         # convert the secret from integer to a 32-bytes in big endian using num.to_bytes(32, 'big')
@@ -668,6 +1870,53 @@ class PrivateKey:
         return encode_base58_checksum(prefix + secret_bytes + suffix)
 
 
+def hmac_digest(keyed, msg):
+    '''HMAC of msg using a copy of an hmac object that has its key (and
+    possibly the start of the message) already set up'''
+    h = keyed.copy()
+    h.update(msg)
+    return h.digest()
+
+
+def sign_batch(items):
+    '''Takes a list of (private_key, z) and returns a list of Signatures.
+    All the k*G points share one inversion to get back to affine and all
+    the k share another one.'''
+    sigs = [None] * len(items)
+    batched = []
+    for i, (private_key, z) in enumerate(items):
+        if private_key.hardened:
+            # hardened keys don't share work with anything
+            sigs[i] = private_key.sign(z)
+        else:
+            batched.append(i)
+    ks = [items[i][0].deterministic_k(items[i][1]) for i in batched]
+    # k*G comes from the generator table, r is the x coordinate
+    points = jacobian_batch_to_affine([g_mul(k) for k in ks])
+    k_invs = batch_inverse(ks, N)
+    for i, (r, y), k_inv in zip(batched, points, k_invs):
+        private_key, z = items[i]
+        recid = y & 1
+        s = (z + r * private_key.secret) * k_inv % N
+        if s > N // 2:
+            s = N - s
+            recid ^= 1
+        sigs[i] = Signature(r, s, recid)
+    return sigs
+
+
+def sign_job(payload):
+    '''Signs a list of (secret, hardened, z) for Executor.map, returning
+    a list of (r, s, recid) so only integers cross the process boundary'''
+    keys = {}
+    items = []
+    for secret, hardened, z in payload:
+        if (secret, hardened) not in keys:
+            keys[secret, hardened] = PrivateKey(secret, hardened=hardened)
+        items.append((keys[secret, hardened], z))
+    return [(sig.r, sig.s, sig.recid) for sig in sign_batch(items)]
+
+
 class PrivateKeyTest(TestCase):
 
     def test_sign(self):
@@ -676,6 +1925,55 @@ class PrivateKeyTest(TestCase):
         sig = pk.sign(z)
         self.assertTrue(pk.point.verify(z, sig))
 
+    def test_deterministic_k(self):
+        # well known RFC6979 secp256k1 test vector
+        pk = PrivateKey(1)
+        z = int.from_bytes(hashlib.sha256(b'Satoshi Nakamoto').digest(), 'big')
+        self.assertEqual(pk.deterministic_k(z), 0x8f8a276c19f4149656b280621e358cce24f5f52542772691ee69063b74f15d15)
+
+    def test_hardened(self):
+        secret = randint(1, N)
+        pk = PrivateKey(secret)
+        hardened = PrivateKey(secret, hardened=True)
+        self.assertEqual(hardened.point, pk.point)
+        for coef in (1, 2, N - 1, randint(1, N)):
+            self.assertEqual(
+                S256Point.from_jacobian(hardened_g_mul(coef)), coef * G)
+        # deterministic k means both modes give the same signature
+        z = randint(0, 2**256)
+        sig = hardened.sign(z)
+        want = pk.sign(z)
+        self.assertEqual((sig.r, sig.s), (want.r, want.s))
+        # only the hardened items are signed on their own, in order
+        items = [(pk, z), (hardened, z + 1), (pk, z + 2), (hardened, z + 3)]
+        with patch('ecc.jacobian_batch_to_affine',
+                   wraps=jacobian_batch_to_affine) as batched, \
+                patch('ecc.hardened_g_mul', wraps=hardened_g_mul) as alone:
+            sigs = sign_batch(items)
+        (points,), _ = batched.call_args
+        self.assertEqual(len(points), 2)
+        self.assertEqual(alone.call_count, 2)
+        for (key, z_i), sig in zip(items, sigs):
+            want = key.sign(z_i)
+            self.assertEqual((sig.r, sig.s, sig.recid),
+                             (want.r, want.s, want.recid))
+        payload = [(secret, key.hardened, z_i) for key, z_i in items]
+        self.assertEqual(sign_job(payload),
+                         [(sig.r, sig.s, sig.recid) for sig in sigs])
+
+    def test_sign_many(self):
+        pk = PrivateKey(randint(1, N))
+        zs = [randint(0, 2**256) for _ in range(5)]
+        sigs = pk.sign_many(zs)
+        for z, sig in zip(zs, sigs):
+            want = pk.sign(z)
+            self.assertEqual((sig.r, sig.s), (want.r, want.s))
+        keys = [PrivateKey(randint(1, N)) for _ in range(3)]
+        items = [(key, z) for key in keys for z in zs[:2]]
+        for (key, z), sig in zip(items, sign_batch(items)):
+            self.assertTrue(key.point.verify(z, sig))
+        self.assertEqual(sign_batch([]), [])
+
     def test_wif(self):
         pk = PrivateKey(2**256 - 2**199)
         expected = 'L5oLkpV3aqBJ4BgssVAsax1iRa77G5CVYnv9adQ6Z87te7TyUdSC'
@@ -1,3 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from operator import xor
+from os import cpu_count
 from unittest import TestCase, TestSuite, TextTestRunner
 
 import hashlib
@@ -7,6 +11,18 @@ SIGHASH_ALL = 1
 SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
 BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BASE58_MAP = {c: i for i, c in enumerate(BASE58_ALPHABET)}
+BASE58_PAIRS = [a + b for a in BASE58_ALPHABET for b in BASE58_ALPHABET]
+BECH32_ALPHABET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32_MAP = {c: i for i, c in enumerate(BECH32_ALPHABET)}
+BECH32_CONST = 1
+BECH32M_CONST = 0x2bc830a3
+BECH32_GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+# xor of the generator terms for every value of the 5 bits shifted out
+BECH32_TABLE = [
+    reduce(xor, (g for j, g in enumerate(BECH32_GENERATOR) if i >> j & 1), 0)
+    for i in range(32)]
+MIN_VIEW_LENGTH = 160
 TWO_WEEKS = 60 * 60 * 24 * 14
 MAX_TARGET = 0xffff * 256**(0x1d - 3)
 
@@ -17,9 +33,136 @@ def run(test):
     TextTestRunner().run(suite)
 
 
+class Executor:
+    '''Runs a module-level function over a list of picklable payloads in a
+    pool of worker processes. Results come back in the same order as the
+    payloads. With 1 worker everything runs in this process.'''
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = cpu_count() or 1
+        self.workers = workers
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def map(self, function, payloads):
+        '''Returns [function(payload) for payload in payloads]'''
+        payloads = list(payloads)
+        if self.workers <= 1 or len(payloads) <= 1:
+            return [function(payload) for payload in payloads]
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        # send the payloads in about one batch per worker
+        chunksize = -(-len(payloads) // self.workers)
+        return list(self.pool.map(function, payloads, chunksize=chunksize))
+
+    def split(self, items):
+        '''Splits items into at most one contiguous list per worker'''
+        size = -(-len(items) // self.workers) or 1
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def close(self):
+        '''Shuts down the worker processes'''
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+class TrackedList(list):
+    '''A list that calls owner.invalidate() before every change, used
+    for the cmds of a Script and the witness of a TxIn so editing them in
+    place reaches the Tx they are in. Copies and pickles are plain lists.'''
+    __slots__ = ('owner',)
+
+    def __init__(self, items=(), owner=None):
+        super().__init__(items)
+        self.owner = owner
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)
+
+    def changed(self):
+        if self.owner is not None:
+            self.owner.invalidate()
+
+    def __setitem__(self, index, value):
+        self.changed()
+        super().__setitem__(index, value)
+
+    def __delitem__(self, index):
+        self.changed()
+        super().__delitem__(index)
+
+    def __iadd__(self, items):
+        self.changed()
+        return super().__iadd__(items)
+
+    def __imul__(self, count):
+        self.changed()
+        return super().__imul__(count)
+
+    def append(self, item):
+        self.changed()
+        super().append(item)
+
+    def insert(self, index, item):
+        self.changed()
+        super().insert(index, item)
+
+    def extend(self, items):
+        self.changed()
+        super().extend(items)
+
+    def pop(self, index=-1):
+        self.changed()
+        return super().pop(index)
+
+    def remove(self, item):
+        self.changed()
+        super().remove(item)
+
+    def clear(self):
+        self.changed()
+        super().clear()
+
+    def reverse(self):
+        self.changed()
+        super().reverse()
+
+    def sort(self, *args, **kwargs):
+        self.changed()
+        super().sort(*args, **kwargs)
+
+
+# hashlib's sha256 is already OpenSSL's, but some OpenSSL 3 builds leave
+# out ripemd160, in which case pycryptodome is used if it is installed
+try:
+    hashlib.new('ripemd160')
+    RIPEMD160_BACKEND = 'hashlib'
+except ValueError:
+    try:
+        from Crypto.Hash import RIPEMD160
+        RIPEMD160_BACKEND = 'pycryptodome'
+    except ImportError:
+        RIPEMD160_BACKEND = None
+
+
+def ripemd160(s):
+    if RIPEMD160_BACKEND == 'hashlib':
+        return hashlib.new('ripemd160', s).digest()
+    elif RIPEMD160_BACKEND == 'pycryptodome':
+        return RIPEMD160.new(s).digest()
+    raise RuntimeError('ripemd160 needs OpenSSL legacy support or pycryptodome')
+
+
 def hash160(s):
     '''sha256 followed by ripemd160'''
-    return hashlib.new('ripemd160', hashlib.sha256(s).digest()).digest()
+    return ripemd160(hashlib.sha256(s).digest())
 
 
 def hash256(s):
@@ -31,38 +174,195 @@ def sha256(s):
     return hashlib.sha256(s).digest()
 
 
+def sha256_midstate(prefix):
+    '''Returns a sha256 object that has already hashed prefix. Hashing
+    prefix + suffix for many suffixes only needs a .copy() and the
+    suffix, only whole 64 byte blocks of prefix are actually saved.'''
+    return hashlib.sha256(prefix)
+
+
+def sha256_from(midstate, suffix):
+    '''sha256 of the midstate's prefix + suffix'''
+    h = midstate.copy()
+    h.update(suffix)
+    return h.digest()
+
+
+def hash256_from(midstate, suffix):
+    '''hash256 of the midstate's prefix + suffix'''
+    h = midstate.copy()
+    h.update(suffix)
+    return hashlib.sha256(h.digest()).digest()
+
+
+TAGGED_MIDSTATES = {}
+
+
+def tagged_hash(tag, s):
+    '''BIP340 tagged hash: sha256(sha256(tag) + sha256(tag) + s)'''
+    # the two tag hashes are exactly one block, so it's hashed only once
+    midstate = TAGGED_MIDSTATES.get(tag)
+    if midstate is None:
+        tag_hash = hashlib.sha256(tag.encode('ascii')).digest()
+        midstate = sha256_midstate(tag_hash + tag_hash)
+        TAGGED_MIDSTATES[tag] = midstate
+    return sha256_from(midstate, s)
+
+
 def encode_base58(s):
     # determine how many 0 bytes (b'\x00') s starts with
-    count = 0
-    for c in s:
-        if c == 0:
-            count += 1
-        else:
-            break
+    count = len(s) - len(bytes(s).lstrip(b'\x00'))
     # convert to big endian integer
     num = int.from_bytes(s, 'big')
-    prefix = '1' * count
-    result = ''
+    # two digits per divmod, they come out least significant first
+    digits = []
     while num > 0:
-        num, mod = divmod(num, 58)
-        result = BASE58_ALPHABET[mod] + result
-    return prefix + result
+        num, mod = divmod(num, 58 * 58)
+        digits.append(BASE58_PAIRS[mod])
+    digits.reverse()
+    # the first pair may start with a zero digit ('1') that is not part
+    # of the number
+    return '1' * count + ''.join(digits).lstrip('1')
 
 
 def encode_base58_checksum(s):
     return encode_base58(s + hash256(s)[:4])
 
 
-def decode_base58(s):
+def raw_decode_base58(s):
+    '''Returns the bytes s encodes, every leading '1' is a 0 byte'''
+    count = len(s) - len(s.lstrip('1'))
     num = 0
-    for c in s:
-        num *= 58
-        num += BASE58_ALPHABET.index(c)
-    combined = num.to_bytes(25, byteorder='big')
-    checksum = combined[-4:]
-    if hash256(combined[:-4])[:4] != checksum:
-        raise ValueError('bad address: {} {}'.format(checksum, hash256(combined[:-4])[:4]))
-    return combined[1:-4]
+    try:
+        for c in s:
+            num = num * 58 + BASE58_MAP[c]
+    except KeyError:
+        raise ValueError('bad base58 character: {}'.format(c))
+    return b'\x00' * count + num.to_bytes((num.bit_length() + 7) // 8, 'big')
+
+
+def decode_base58_checksum(s):
+    '''Decodes a base58check string of any length (addresses, WIF,
+    extended keys) and returns everything in front of the checksum'''
+    combined = raw_decode_base58(s)
+    payload, checksum = combined[:-4], combined[-4:]
+    if len(combined) < 4 or hash256(payload)[:4] != checksum:
+        raise ValueError('bad address: {} {}'.format(checksum, hash256(payload)[:4]))
+    return payload
+
+
+def decode_base58(s):
+    '''Returns the hash160 of a base58 address, without the version byte'''
+    return decode_base58_checksum(s)[1:]
+
+
+def encode_base58_many(payloads, checksum=True):
+    '''Returns the base58 (base58check when checksum) encoding of every
+    payload'''
+    if not checksum:
+        return [encode_base58(s) for s in payloads]
+    sha256 = hashlib.sha256
+    return [encode_base58(s + sha256(sha256(s).digest()).digest()[:4])
+            for s in payloads]
+
+
+def decode_base58_many(strings, checksum=True):
+    '''Decodes every string, stripping and checking the checksum when
+    checksum is set'''
+    if not checksum:
+        return [raw_decode_base58(s) for s in strings]
+    return [decode_base58_checksum(s) for s in strings]
+
+
+def bech32_polymod(values, chk=1):
+    '''BCH checksum of a list of 5 bit values from BIP173'''
+    table = BECH32_TABLE
+    for v in values:
+        chk = ((chk & 0x1ffffff) << 5) ^ v ^ table[chk >> 25]
+    return chk
+
+
+def bech32_hrp_expand(hrp):
+    '''The human readable part as 5 bit values for the checksum'''
+    return [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+
+
+def bech32_encode(hrp, data, const=BECH32_CONST):
+    '''Returns the bech32 (or bech32m with BECH32M_CONST) string for the
+    human readable part and the list of 5 bit values data'''
+    polymod = bech32_polymod(bech32_hrp_expand(hrp) + data + [0] * 6) ^ const
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join([BECH32_ALPHABET[d] for d in data + checksum])
+
+
+def bech32_decode(s):
+    '''Returns the human readable part, the 5 bit values and the checksum
+    constant (BECH32_CONST or BECH32M_CONST) of a bech32 string'''
+    if len(s) > 90 or s.lower() != s and s.upper() != s:
+        raise ValueError('bad bech32 string: {}'.format(s))
+    s = s.lower()
+    pos = s.rfind('1')
+    if pos < 1 or pos + 7 > len(s):
+        raise ValueError('bad bech32 separator: {}'.format(s))
+    hrp = s[:pos]
+    if any(ord(c) < 33 or ord(c) > 126 for c in hrp):
+        raise ValueError('bad bech32 prefix: {}'.format(hrp))
+    try:
+        data = [BECH32_MAP[c] for c in s[pos + 1:]]
+    except KeyError:
+        raise ValueError('bad bech32 character: {}'.format(s))
+    const = bech32_polymod(bech32_hrp_expand(hrp) + data)
+    if const not in (BECH32_CONST, BECH32M_CONST):
+        raise ValueError('bad bech32 checksum: {}'.format(s))
+    return hrp, data[:-6], const
+
+
+def convert_bits(data, from_bits, to_bits, pad=True):
+    '''Regroups a sequence of from_bits values into to_bits values'''
+    acc = 0
+    bits = 0
+    result = []
+    max_value = (1 << to_bits) - 1
+    for value in data:
+        if value >> from_bits:
+            raise ValueError('value does not fit in {} bits'.format(from_bits))
+        acc = (acc << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            result.append((acc >> bits) & max_value)
+    if pad:
+        if bits:
+            result.append((acc << (to_bits - bits)) & max_value)
+    elif bits >= from_bits or (acc << (to_bits - bits)) & max_value:
+        raise ValueError('bad padding')
+    return result
+
+
+def encode_segwit_address(version, program, testnet=False):
+    '''Returns the bech32 address of a witness program, version 0 uses
+    bech32 and later versions bech32m (BIP350)'''
+    hrp = 'tb' if testnet else 'bc'
+    const = BECH32_CONST if version == 0 else BECH32M_CONST
+    return bech32_encode(hrp, [version] + convert_bits(program, 8, 5), const)
+
+
+def decode_segwit_address(address):
+    '''Returns (version, program, testnet) for a segwit address'''
+    hrp, data, const = bech32_decode(address)
+    if hrp not in ('bc', 'tb'):
+        raise ValueError('unknown network: {}'.format(hrp))
+    if not data or data[0] > 16:
+        raise ValueError('bad witness version: {}'.format(address))
+    version = data[0]
+    program = bytes(convert_bits(data[1:], 5, 8, pad=False))
+    if len(program) < 2 or len(program) > 40:
+        raise ValueError('bad witness program length: {}'.format(address))
+    if version == 0 and len(program) not in (20, 32):
+        raise ValueError('bad witness program length: {}'.format(address))
+    if const != (BECH32_CONST if version == 0 else BECH32M_CONST):
+        raise ValueError('wrong checksum for version {}'.format(version))
+    return version, program, hrp == 'tb'
 
 
 def little_endian_to_int(b):
@@ -94,6 +394,32 @@ def read_varint(s):
         return i
 
 
+def buffer_slice(buf, start, end):
+    '''Returns buf[start:end] of a memoryview as a view when it's long
+    enough for that to save memory and buf is read-only, otherwise as a
+    bytes copy. The underlying buffer must not change while the view is
+    in use.'''
+    # a memoryview object is 184 bytes, a bytes object 33 plus its length
+    if end - start < MIN_VIEW_LENGTH or not memoryview(buf).readonly:
+        # a writable buffer could change under the view
+        return bytes(buf[start:end])
+    return buf[start:end]
+
+
+def read_varint_buffer(buf, offset):
+    '''Reads a variable integer at offset of a bytes-like buffer.
+    Returns the integer and the offset just past it'''
+    i = buf[offset]
+    if i == 0xfd:
+        return int.from_bytes(buf[offset + 1:offset + 3], 'little'), offset + 3
+    elif i == 0xfe:
+        return int.from_bytes(buf[offset + 1:offset + 5], 'little'), offset + 5
+    elif i == 0xff:
+        return int.from_bytes(buf[offset + 1:offset + 9], 'little'), offset + 9
+    else:
+        return i, offset + 1
+
+
 def encode_varint(i):
     '''encodes an integer as a varint'''
     if i < 0xfd:
@@ -118,6 +444,16 @@ def h160_to_p2pkh_address(h160, testnet=False):
     return encode_base58_checksum(prefix + h160)
 
 
+def h160_to_p2wpkh_address(h160, testnet=False):
+    '''Takes a byte sequence hash160 and returns a p2wpkh address string'''
+    return encode_segwit_address(0, h160, testnet)
+
+
+def h256_to_p2wsh_address(h256, testnet=False):
+    '''Takes a byte sequence sha256 and returns a p2wsh address string'''
+    return encode_segwit_address(0, h256, testnet)
+
+
 def h160_to_p2sh_address(h160, testnet=False):
     '''Takes a byte sequence hash160 and returns a p2sh address string'''
     # p2sh has a prefix of b'\x05' for mainnet, b'\xc4' for testnet
@@ -287,6 +623,49 @@ def murmur3(data, seed=0):
 
 class HelperTest(TestCase):
 
+    def test_executor(self):
+        payloads = [b'', b'a', b'ab', b'abc', b'abcd']
+        want = [hash256(p) for p in payloads]
+        for workers in (1, 2):
+            with Executor(workers=workers) as executor:
+                self.assertEqual(executor.map(hash256, payloads), want)
+                self.assertEqual(executor.map(hash256, []), [])
+        executor = Executor(workers=2)
+        self.assertEqual(executor.split([1, 2, 3]), [[1, 2], [3]])
+        self.assertEqual(executor.split([]), [])
+
+    def test_hashes(self):
+        self.assertEqual(hash160(b'').hex(), 'b472a266d0bd89c13706a4132ccfb16f7c3b9fcb')
+        self.assertEqual(ripemd160(b'abc').hex(), '8eb208f7e05d987a9b044a8e98c6b087f15a0bfc')
+        prefix = bytes(range(100))
+        midstate = sha256_midstate(prefix)
+        for suffix in (b'', b'a', bytes(200)):
+            self.assertEqual(sha256_from(midstate, suffix), sha256(prefix + suffix))
+            self.assertEqual(hash256_from(midstate, suffix), hash256(prefix + suffix))
+        tag_hash = sha256(b'BIP0340/challenge')
+        want = sha256(tag_hash + tag_hash + b'msg')
+        self.assertEqual(tagged_hash('BIP0340/challenge', b'msg'), want)
+        self.assertEqual(tagged_hash('BIP0340/challenge', b'msg'), want)
+
+    def test_buffer_slice(self):
+        buf = memoryview(bytes(range(256)) * 2)
+        self.assertEqual(type(buffer_slice(buf, 1, 33)), bytes)
+        self.assertEqual(buffer_slice(buf, 1, 33), bytes(range(1, 33)))
+        view = buffer_slice(buf, 10, 10 + MIN_VIEW_LENGTH)
+        self.assertEqual(type(view), memoryview)
+        self.assertEqual(view.obj, buf.obj)
+        # writable buffers are always copied
+        buf = memoryview(bytearray(range(256)) * 2)
+        view = buffer_slice(buf, 10, 10 + MIN_VIEW_LENGTH)
+        self.assertEqual(type(view), bytes)
+        buf[10] = 0xff
+        self.assertEqual(view[0], 10)
+
+    def test_read_varint_buffer(self):
+        for i in (0, 0xfc, 0xfd, 0xffff, 0x10000, 0xffffffff, 0x100000000):
+            buf = memoryview(b'\xaa' + encode_varint(i) + b'\xbb')
+            self.assertEqual(read_varint_buffer(buf, 1), (i, len(buf) - 1))
+
     def test_little_endian_to_int(self):
         h = bytes.fromhex('99c3980000000000')
         want = 10011545
@@ -310,6 +689,49 @@ class HelperTest(TestCase):
         self.assertEqual(h160, want)
         got = encode_base58_checksum(b'\x6f' + bytes.fromhex(h160))
         self.assertEqual(got, addr)
+        for payload in (b'', b'\x00', b'\x00\x00\x01', b'\x00\xff' * 20, bytes(range(1, 82))):
+            self.assertEqual(raw_decode_base58(encode_base58(payload)), payload)
+            self.assertEqual(decode_base58_checksum(encode_base58_checksum(payload)), payload)
+        self.assertEqual(encode_base58(b'\x00\x00\x01'), '112')
+        self.assertEqual(encode_base58(bytes.fromhex('0000287fb4cd')), '11233QC4')
+        # WIF is 34 bytes with the compressed flag
+        wif = 'L5oLkpV3aqBJ4BgssVAsax1iRa77G5CVYnv9adQ6Z87te7TyUdSC'
+        payload = decode_base58_checksum(wif)
+        self.assertEqual(len(payload), 34)
+        self.assertEqual(encode_base58_checksum(payload), wif)
+        with self.assertRaises(ValueError):
+            decode_base58(addr[:-1] + 'g')
+        with self.assertRaises(ValueError):
+            decode_base58(addr[:-1] + '0')
+
+    def test_base58_many(self):
+        payloads = [bytes([i]) * (i % 40) for i in range(50)]
+        encoded = encode_base58_many(payloads)
+        self.assertEqual(encoded, [encode_base58_checksum(p) for p in payloads])
+        self.assertEqual(decode_base58_many(encoded), payloads)
+        encoded = encode_base58_many(payloads, checksum=False)
+        self.assertEqual(decode_base58_many(encoded, checksum=False), payloads)
+
+    def test_bech32(self):
+        # checksum vectors from BIP173 and BIP350
+        for s in ('A12UEL5L', 'a12uel5l', 'abcdef1qpzry9x8gf2tvdw0s3jn54khce6mua7lmqqqxw'):
+            self.assertEqual(bech32_decode(s)[2], BECH32_CONST)
+        for s in ('A1LQFN3A', 'abcdef1l7aum6echk45nj3s0wdvt2fg8x9yrzpqzd3ryx'):
+            self.assertEqual(bech32_decode(s)[2], BECH32M_CONST)
+        for s in ('A12UEL5l', 'a12uel5m', 'pzry9x0s0muk', '1pzry9x0s0muk', 'a1b2'):
+            with self.assertRaises(ValueError):
+                bech32_decode(s)
+        hrp, data, const = bech32_decode('abcdef1qpzry9x8gf2tvdw0s3jn54khce6mua7lmqqqxw')
+        self.assertEqual(bech32_encode(hrp, data, const), 'abcdef1qpzry9x8gf2tvdw0s3jn54khce6mua7lmqqqxw')
+        h160 = bytes.fromhex('751e76e8199196d454941c45d1b3a323f1433bd6')
+        address = 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+        self.assertEqual(h160_to_p2wpkh_address(h160), address)
+        self.assertEqual(decode_segwit_address(address), (0, h160, False))
+        # version 0 with a bech32m checksum
+        with self.assertRaises(ValueError):
+            decode_segwit_address(bech32_encode('bc', [0] + convert_bits(h160, 8, 5), BECH32M_CONST))
+        self.assertEqual(BECH32_TABLE[1], BECH32_GENERATOR[0])
+        self.assertEqual(BECH32_TABLE[0b10100], BECH32_GENERATOR[2] ^ BECH32_GENERATOR[4])
 
     def test_p2pkh_address(self):
         h160 = bytes.fromhex('74d691da1574e6b3c192ecfb52cc8984ee7b6c56')
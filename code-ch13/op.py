@@ -4,13 +4,14 @@ from logging import getLogger
 from unittest import TestCase
 
 from ecc import (
-    S256Point,
+    POINT_CACHE,
     Signature,
 )
 
 from helper import (
     hash160,
     hash256,
+    ripemd160,
 )
 
 
@@ -619,7 +620,7 @@ def op_ripemd160(stack):
     if len(stack) < 1:
         return False
     element = stack.pop()
-    stack.append(hashlib.new('ripemd160', element).digest())
+    stack.append(ripemd160(element))
     return True
 
 
@@ -667,10 +668,11 @@ def op_checksig(stack, z):
     sec_pubkey = stack.pop()
     # the next element of the stack is the DER signature
     # take off the last byte of the signature as that's the hash_type
-    der_signature = stack.pop()[:-1]
+    # (a memoryview slice so the signature isn't copied)
+    der_signature = memoryview(stack.pop())[:-1]
     # parse the serialized pubkey and signature into objects
     try:
-        point = S256Point.parse(sec_pubkey)
+        point = POINT_CACHE.parse(sec_pubkey)
         sig = Signature.parse(der_signature)
     except (ValueError, SyntaxError) as e:
         LOGGER.info(e)
@@ -703,12 +705,12 @@ def op_checkmultisig(stack, z):
     der_signatures = []
     for _ in range(m):
         # signature is assumed to be using SIGHASH_ALL
-        der_signatures.append(stack.pop()[:-1])
+        der_signatures.append(memoryview(stack.pop())[:-1])
     # OP_CHECKMULTISIG bug
     stack.pop()
     try:
         # parse all the points
-        points = [S256Point.parse(sec) for sec in sec_pubkeys]
+        points = [POINT_CACHE.parse(sec) for sec in sec_pubkeys]
         # parse all the signatures
         sigs = [Signature.parse(der) for der in der_signatures]
         # loop through the signatures
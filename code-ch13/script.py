@@ -3,14 +3,23 @@ from logging import getLogger
 from unittest import TestCase
 
 from helper import (
+    buffer_slice,
     decode_base58,
+    decode_base58_checksum,
+    decode_segwit_address,
+    encode_base58_many,
+    encode_segwit_address,
     encode_varint,
     h160_to_p2pkh_address,
     h160_to_p2sh_address,
+    h160_to_p2wpkh_address,
+    h256_to_p2wsh_address,
     int_to_little_endian,
     little_endian_to_int,
     read_varint,
+    read_varint_buffer,
     sha256,
+    TrackedList,
 )
 from op import (
     op_equal,
@@ -49,13 +58,67 @@ LOGGER = getLogger(__name__)
 
 
 class Script:
+    # the raw bytes until the cmds are parsed, and the TxIn or TxOut this
+    # script is in
+    __slots__ = ('_cmds', '_raw', '_owner')
 
     def __init__(self, cmds=None):
+        self._owner = None
         if cmds is None:
             self.cmds = []
         else:
             self.cmds = cmds
 
+    @property
+    def cmds(self):
+        if self._cmds is None:
+            # scripts from parse_buffer are only parsed when needed
+            self._cmds = TrackedList(parse_cmds(self._raw), self)
+            self._raw = None
+        return self._cmds
+
+    @cmds.setter
+    def cmds(self, cmds):
+        # editing the cmds in place tells the owner too
+        self._cmds = TrackedList(cmds, self)
+        self._raw = None
+        self.invalidate()
+
+    def invalidate(self):
+        '''Tells the TxIn or TxOut this script is in that it changed'''
+        if self._owner is not None:
+            self._owner.invalidate()
+
+    def __copy__(self):
+        # a copy has its own cmds and isn't in any TxIn or TxOut yet
+        script = Script.__new__(type(self))
+        if self._cmds is None:
+            script._cmds = None
+        else:
+            script._cmds = TrackedList(self._cmds, script)
+        script._raw = self._raw
+        script._owner = None
+        return script
+
+    def __deepcopy__(self, memo):
+        # the cmds themselves are bytes and ints, which can't change
+        return self.__copy__()
+
+    def __getstate__(self):
+        # scripts that were never parsed are pickled as their raw bytes
+        if self._cmds is None:
+            return {'_raw': bytes(self._raw)}
+        return {'_cmds': list(self._cmds)}
+
+    def __setstate__(self, state):
+        self._owner = None
+        if '_raw' in state:
+            self._cmds = None
+            self._raw = state['_raw']
+        else:
+            self._cmds = TrackedList(state['_cmds'], self)
+            self._raw = None
+
     def __repr__(self):
         result = []
         for cmd in self.cmds:
@@ -115,43 +178,76 @@ class Script:
             raise SyntaxError('parsing script failed')
         return cls(cmds)
 
+    @classmethod
+    def parse_buffer(cls, buf, offset=0):
+        '''Takes a bytes-like buffer and the offset of a script in it.
+        The raw script is kept (long ones as a view into buf when it's
+        read-only, so it must not change while the Script is in use) and
+        only split into cmds when they are asked for. Returns the Script
+        and the offset just past it.'''
+        length, offset = read_varint_buffer(buf, offset)
+        end = offset + length
+        if end > len(buf):
+            raise SyntaxError('parsing script failed')
+        script = cls.__new__(cls)
+        script._cmds = None
+        script._raw = buffer_slice(buf, offset, end)
+        script._owner = None
+        return script, end
+
     def raw_serialize(self):
-        # initialize what we'll send back
-        result = b''
+        result = bytearray()
+        self.raw_serialize_into(result)
+        return bytes(result)
+
+    def raw_serialize_into(self, buf):
+        '''Appends the serialization without the length to the bytearray buf'''
+        if self._cmds is None:
+            # never parsed, so the raw bytes are still the serialization
+            buf += self._raw
+            return
         # go through each cmd
         for cmd in self.cmds:
             # if the cmd is an integer, it's an opcode
             if type(cmd) == int:
-                # turn the cmd into a single byte integer using int_to_little_endian
-                result += int_to_little_endian(cmd, 1)
+                # the opcode is a single byte
+                buf.append(cmd)
             else:
                 # otherwise, this is an element
                 # get the length in bytes
                 length = len(cmd)
                 # for large lengths, we have to use a pushdata opcode
                 if length < 75:
-                    # turn the length into a single byte integer
-                    result += int_to_little_endian(length, 1)
+                    # the length is a single byte
+                    buf.append(length)
                 elif length > 75 and length < 0x100:
                     # 76 is pushdata1
-                    result += int_to_little_endian(76, 1)
-                    result += int_to_little_endian(length, 1)
+                    buf.append(76)
+                    buf.append(length)
                 elif length >= 0x100 and length <= 520:
                     # 77 is pushdata2
-                    result += int_to_little_endian(77, 1)
-                    result += int_to_little_endian(length, 2)
+                    buf.append(77)
+                    buf += int_to_little_endian(length, 2)
                 else:
                     raise ValueError('too long an cmd')
-                result += cmd
-        return result
+                buf += cmd
 
     def serialize(self):
-        # get the raw serialization (no prepended length)
-        result = self.raw_serialize()
-        # get the length of the whole thing
-        total = len(result)
-        # encode_varint the total length of the result and prepend
-        return encode_varint(total) + result
+        result = bytearray()
+        self.serialize_into(result)
+        return bytes(result)
+
+    def serialize_into(self, buf):
+        '''Appends the length prefixed serialization to the bytearray buf'''
+        if self._cmds is None:
+            buf += encode_varint(len(self._raw))
+            buf += self._raw
+            return
+        # the length isn't known until the cmds are written, so write them
+        # first and slip the varint in front, which only moves this script
+        start = len(buf)
+        self.raw_serialize_into(buf)
+        buf[start:start] = encode_varint(len(buf) - start)
 
     def evaluate(self, z, witness):
         # create a copy as we may need to add to this list if we have a
@@ -275,6 +371,22 @@ class Script:
             and type(self.cmds[1]) == bytes and len(self.cmds[1]) == 32
     # end::source5[]
 
+    def witness_version(self):
+        '''Returns the witness version if this is a
+        <version> <2 to 40 byte program> ScriptPubKey, otherwise None.
+        Version 0 programs have to be 20 or 32 bytes (BIP141).'''
+        if len(self.cmds) != 2 or type(self.cmds[1]) != bytes \
+                or not 2 <= len(self.cmds[1]) <= 40:
+            return None
+        if self.cmds[0] == 0x00:
+            if len(self.cmds[1]) not in (20, 32):
+                return None
+            return 0
+        # OP_1 (0x51) to OP_16 (0x60)
+        if type(self.cmds[0]) == int and 0x51 <= self.cmds[0] <= 0x60:
+            return self.cmds[0] - 0x50
+        return None
+
     def address(self, testnet=False):
         '''Returns the address corresponding to the script'''
         if self.is_p2pkh_script_pubkey():  # p2pkh
@@ -287,9 +399,92 @@ class Script:
             h160 = self.cmds[1]
             # convert to p2sh address using h160_to_p2sh_address (remember testnet)
             return h160_to_p2sh_address(h160, testnet)
+        elif self.is_p2wpkh_script_pubkey():  # p2wpkh
+            return h160_to_p2wpkh_address(self.cmds[1], testnet)
+        elif self.is_p2wsh_script_pubkey():  # p2wsh
+            return h256_to_p2wsh_address(self.cmds[1], testnet)
+        version = self.witness_version()
+        if version is not None:
+            # later witness versions like taproot use bech32m
+            return encode_segwit_address(version, self.cmds[1], testnet)
         raise ValueError('Unknown ScriptPubKey')
 
 
+def parse_cmds(raw):
+    '''Splits a raw script (without the length in front) into cmds,
+    walking it with an offset instead of reading from a stream'''
+    cmds = []
+    length = len(raw)
+    i = 0
+    while i < length:
+        current_byte = raw[i]
+        i += 1
+        if current_byte >= 1 and current_byte <= 75:
+            # push the next current_byte bytes
+            cmds.append(bytes(raw[i:i + current_byte]))
+            i += current_byte
+        elif current_byte == 76:
+            # op_pushdata1
+            data_length = raw[i] if i < length else 0
+            cmds.append(bytes(raw[i + 1:i + 1 + data_length]))
+            i += data_length + 1
+        elif current_byte == 77:
+            # op_pushdata2
+            data_length = int.from_bytes(raw[i:i + 2], 'little')
+            cmds.append(bytes(raw[i + 2:i + 2 + data_length]))
+            i += data_length + 2
+        else:
+            cmds.append(current_byte)
+    if i != length:
+        raise SyntaxError('parsing script failed')
+    return cmds
+
+
+def address_to_script(address):
+    '''Returns the ScriptPubKey that pays to a base58 or bech32 address'''
+    if address[:3].lower() in ('bc1', 'tb1'):
+        version, program, _ = decode_segwit_address(address)
+        return Script([0x50 + version if version else 0x00, program])
+    payload = decode_base58_checksum(address)
+    if len(payload) != 21:
+        raise ValueError('bad address length: {}'.format(address))
+    prefix, h160 = payload[0], payload[1:]
+    if prefix in (0x00, 0x6f):
+        return p2pkh_script(h160)
+    elif prefix in (0x05, 0xc4):
+        return p2sh_script(h160)
+    raise ValueError('unknown address version: {}'.format(prefix))
+
+
+def scripts_to_addresses(script_pubkeys, testnet=False):
+    '''Returns the address of every ScriptPubKey, None for the ones that
+    don't have one. All the base58 addresses are encoded in one call.'''
+    results = [None] * len(script_pubkeys)
+    base58_indexes = []
+    payloads = []
+    p2pkh_prefix, p2sh_prefix = (b'\x6f', b'\xc4') if testnet else (b'\x00', b'\x05')
+    for i, script_pubkey in enumerate(script_pubkeys):
+        if script_pubkey.is_p2pkh_script_pubkey():
+            base58_indexes.append(i)
+            payloads.append(p2pkh_prefix + script_pubkey.cmds[2])
+        elif script_pubkey.is_p2sh_script_pubkey():
+            base58_indexes.append(i)
+            payloads.append(p2sh_prefix + script_pubkey.cmds[1])
+        else:
+            version = script_pubkey.witness_version()
+            if version is not None:
+                results[i] = encode_segwit_address(
+                    version, script_pubkey.cmds[1], testnet)
+    for i, address in zip(base58_indexes, encode_base58_many(payloads)):
+        results[i] = address
+    return results
+
+
+def addresses_to_scripts(addresses):
+    '''Returns the ScriptPubKey of every address'''
+    return [address_to_script(address) for address in addresses]
+
+
 class ScriptTest(TestCase):
 
     def test_parse(self):
@@ -306,6 +501,26 @@ class ScriptTest(TestCase):
         script = Script.parse(script_pubkey)
         self.assertEqual(script.serialize().hex(), want)
 
+    def test_parse_buffer(self):
+        raw = bytes.fromhex('6a47304402207899531a52d59a6de200179928ca900254a36b8dff8bb75f5f5d71b1cdc26125022008b422690b8461cb52c3cc30330b23d574351872b7c361e9aae3649071c1a7160121035d5c93d9ac96881f19ba1f686f15f009ded7c62efe85a872e6a19b43c15a2937')
+        buf = memoryview(b'\xff' + raw + b'\xff')
+        script, offset = Script.parse_buffer(buf, 1)
+        self.assertEqual(offset, len(raw) + 1)
+        self.assertEqual(script.serialize(), raw)
+        want = Script.parse(BytesIO(raw))
+        self.assertEqual(script.cmds, want.cmds)
+        self.assertEqual(script.serialize(), raw)
+        # changing the cmds changes the serialization
+        script.cmds.pop()
+        self.assertEqual(script.serialize(), Script(want.cmds[:1]).serialize())
+        pushdata = Script([b'\x01' * 80, 0xac, b'\x02' * 300])
+        script, _ = Script.parse_buffer(memoryview(pushdata.serialize()))
+        self.assertEqual(script.cmds, pushdata.cmds)
+        with self.assertRaises(SyntaxError):
+            Script.parse_buffer(memoryview(raw[:-1]))
+        with self.assertRaises(SyntaxError):
+            Script.parse_buffer(memoryview(b'\x02\x05\x01'))[0].cmds
+
     def test_address(self):
         address_1 = '1BenRpVUFK65JFWcQSuHnJKzc4M8ZP8Eqa'
         h160 = decode_base58(address_1)
@@ -319,3 +534,41 @@ class ScriptTest(TestCase):
         self.assertEqual(p2sh_script_pubkey.address(), address_3)
         address_4 = '2N3u1R6uwQfuobCqbCgBkpsgBxvr1tZpe7B'
         self.assertEqual(p2sh_script_pubkey.address(testnet=True), address_4)
+        # BIP173 and BIP350 examples
+        h160 = bytes.fromhex('751e76e8199196d454941c45d1b3a323f1433bd6')
+        address_5 = 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'
+        self.assertEqual(p2wpkh_script(h160).address(), address_5)
+        h256 = sha256(b'')
+        self.assertTrue(p2wsh_script(h256).address(testnet=True).startswith('tb1q'))
+        x_only = bytes.fromhex('79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798')
+        address_6 = 'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0'
+        self.assertEqual(Script([0x51, x_only]).address(), address_6)
+        with self.assertRaises(ValueError):
+            Script([0x6a, h160]).address()
+        # version 0 programs are 20 or 32 bytes, later versions 2 to 40
+        for length in (2, 19, 21, 31, 33, 40):
+            with self.assertRaises(ValueError):
+                Script([0x00, bytes(length)]).address()
+            self.assertIsNotNone(Script([0x52, bytes(length)]).address())
+
+    def test_address_to_script(self):
+        h160 = bytes.fromhex('751e76e8199196d454941c45d1b3a323f1433bd6')
+        scripts = [
+            p2pkh_script(h160), p2sh_script(h160), p2wpkh_script(h160),
+            p2wsh_script(sha256(b'')), Script([0x51, sha256(b'')]),
+        ]
+        for testnet in (False, True):
+            addresses = scripts_to_addresses(scripts, testnet)
+            self.assertEqual(addresses, [s.address(testnet) for s in scripts])
+            got = addresses_to_scripts(addresses)
+            self.assertEqual([s.serialize() for s in got],
+                             [s.serialize() for s in scripts])
+        self.assertEqual(address_to_script('BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4').serialize(),
+                         p2wpkh_script(h160).serialize())
+        self.assertEqual(scripts_to_addresses([Script([0x6a, h160])]), [None])
+        self.assertEqual(scripts_to_addresses([Script([0x00, h160[:19]])]), [None])
+        for bad in ('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5',
+                    'bc1pw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4',
+                    '1BenRpVUFK65JFWcQSuHnJKzc4M8ZP8Eqb'):
+            with self.assertRaises(ValueError):
+                address_to_script(bad)
@@ -1,17 +1,26 @@
+from copy import copy, deepcopy
 from io import BytesIO
 from unittest import TestCase
+from unittest.mock import patch
 
 import json
+import pickle
 import requests
 
-from ecc import PrivateKey
+from ecc import hardened_g_mul, PrivateKey, Signature, sign_job
 from helper import (
+    buffer_slice,
     encode_varint,
+    Executor,
     hash256,
+    hash256_from,
     int_to_little_endian,
     little_endian_to_int,
     read_varint,
+    read_varint_buffer,
+    sha256_midstate,
     SIGHASH_ALL,
+    TrackedList,
 )
 from script import p2pkh_script, Script
 
@@ -35,12 +44,10 @@ class TxFetcher:
                 raw = bytes.fromhex(response.text.strip())
             except ValueError:
                 raise ValueError('unexpected response: {}'.format(response.text))
-            tx = Tx.parse(BytesIO(raw), testnet=testnet)
-            # make sure the tx we got matches to the hash we requested
-            if tx.segwit:
-                computed = tx.id()
-            else:
-                computed = hash256(raw)[::-1].hex()
+            tx, _ = Tx.parse_buffer(raw, testnet=testnet)
+            # make sure the tx we got matches to the hash we requested,
+            # the id of a legacy tx is hashed from the raw bytes
+            computed = tx.id()
             if computed != tx_id:
                 raise RuntimeError('server lied: {} vs {}'.format(computed, tx_id))
             cls.cache[tx_id] = tx
@@ -51,7 +58,7 @@ class TxFetcher:
     def load_cache(cls, filename):
         disk_cache = json.loads(open(filename, 'r').read())
         for k, raw_hex in disk_cache.items():
-            cls.cache[k] = Tx.parse(BytesIO(bytes.fromhex(raw_hex)))
+            cls.cache[k], _ = Tx.parse_buffer(bytes.fromhex(raw_hex))
 
     @classmethod
     def dump_cache(cls, filename):
@@ -61,9 +68,53 @@ class TxFetcher:
             f.write(s)
 
 
+# fields that are part of the serialization, assigning any of them makes
+# the cached serializations and hashes stale
+TX_FIELDS = frozenset(('version', 'tx_ins', 'tx_outs', 'locktime', 'segwit'))
+TX_IN_FIELDS = frozenset(
+    ('prev_tx', 'prev_index', 'script_sig', 'sequence', 'witness'))
+TX_OUT_FIELDS = frozenset(('amount', 'script_pubkey'))
+# serialize(), the legacy serialization if that's different, hash(),
+# witness_hash(), the inputs and outputs when they were cached, which is
+# None while nothing is, and the BIP143 parts
+TX_CACHES = ('_raw', '_legacy', '_hash', '_witness_hash', '_items',
+             '_hash_prevouts', '_hash_sequence', '_hash_outputs',
+             '_bip143_midstate')
+
+
+def set_fields(obj, **fields):
+    '''Sets the attributes of a new object without going through its
+    change hooks'''
+    for name, value in fields.items():
+        object.__setattr__(obj, name, value)
+
+
+def take_ownership(owner, item):
+    '''Makes an input, output or script tell owner when it changes. It
+    can only tell one owner, so one still used by another raises a
+    ValueError, use a copy of it there instead.'''
+    current = item._owner
+    if current is not owner:
+        if current is not None and current.holds(item):
+            raise ValueError(
+                'this {} is already in a {}, use a copy of it'.format(
+                    type(item).__name__, type(current).__name__))
+        item._owner = owner
+
+
+def unpickle_tx(cls, raw, testnet):
+    '''Rebuilds a pickled Tx or LazyTx from its serialization'''
+    tx, _ = cls.parse_buffer(raw, testnet=testnet)
+    return tx
+
+
 # tag::source1[]
 class Tx:
     command = b'tx'
+    # slots instead of a __dict__ keep many transactions small in memory
+    __slots__ = (
+        'version', 'tx_ins', 'tx_outs', 'locktime', 'testnet', 'segwit',
+    ) + TX_CACHES
 
     def __init__(self, version, tx_ins, tx_outs, 
         locktime, testnet=False, segwit=False):
@@ -73,11 +124,77 @@ class Tx:
         self.locktime = locktime
         self.testnet = testnet
         self.segwit = segwit
-        self._hash_prevouts = None
-        self._hash_sequence = None
-        self._hash_outputs = None
     # end::source1[]
 
+    def __setattr__(self, name, value):
+        if name in TX_FIELDS and self._items is not None:
+            self.invalidate()
+        super().__setattr__(name, value)
+
+    def __copy__(self):
+        # the inputs and outputs are copied too, they can only tell one Tx
+        # that they changed
+        tx = Tx.__new__(type(self))
+        set_fields(
+            tx, version=self.version, locktime=self.locktime,
+            testnet=self.testnet, segwit=self.segwit)
+        tx.tx_ins = [copy(tx_in) for tx_in in self.tx_ins]
+        tx.tx_outs = [copy(tx_out) for tx_out in self.tx_outs]
+        return tx
+
+    def __deepcopy__(self, memo):
+        # a copy shares nothing that can change
+        return copy(self)
+
+    def __reduce__(self):
+        # the change hooks need fields that aren't set yet while unpickling,
+        # so pickle the serialization instead
+        return unpickle_tx, (type(self), self.serialize(), self.testnet)
+
+    def __getattr__(self, name):
+        # only called for slots that were never set, caches start empty
+        if name in TX_CACHES:
+            return None
+        raise AttributeError("'{}' object has no attribute '{}'".format(
+            type(self).__name__, name))
+
+    def invalidate(self):
+        '''Forgets the cached serializations and hashes. Changing a field
+        of this Tx, of its inputs and outputs or of their scripts, editing
+        the cmds or witness lists and adding, replacing or removing inputs
+        and outputs all do this by themselves.'''
+        # none of the caches are fields, so skip the change hooks
+        for name in TX_CACHES:
+            object.__setattr__(self, name, None)
+
+    def holds(self, item):
+        '''Whether item is one of the inputs or outputs'''
+        return item in self.tx_ins or item in self.tx_outs
+
+    def items_changed(self):
+        '''Whether inputs or outputs were added, removed or replaced
+        since the caches were filled'''
+        tx_ins, tx_outs = self._items
+        # comparing lists checks identity first, which is all that's
+        # needed here, so this is a quick scan
+        return tx_ins != self.tx_ins or tx_outs != self.tx_outs
+
+    def check_cache(self):
+        '''Invalidates the caches if the lists of inputs or outputs
+        changed since they were filled'''
+        if self._items is not None and self.items_changed():
+            self.invalidate()
+
+    def mark_cached(self):
+        '''Makes the inputs and outputs tell this Tx when they change and
+        remembers which they were when the first cache was filled'''
+        if self._items is None:
+            for item in self.tx_ins:
+                take_ownership(self, item)
+            for item in self.tx_outs:
+                take_ownership(self, item)
+            self._items = (list(self.tx_ins), list(self.tx_outs))
+
     def __repr__(self):
         tx_ins = ''
         for tx_in in self.tx_ins:
@@ -100,9 +217,27 @@ class Tx:
     # tag::source5[]
     def hash(self):
         '''Binary hash of the legacy serialization'''
-        return hash256(self.serialize_legacy())[::-1]
+        self.check_cache()
+        if self._hash is None:
+            self._hash = hash256(self.serialize_legacy())[::-1]
+            self.mark_cached()
+        return self._hash
     # end::source5[]
 
+    def witness_hash(self):
+        '''Binary hash of the full serialization, witnesses included'''
+        if not self.segwit:
+            return self.hash()
+        self.check_cache()
+        if self._witness_hash is None:
+            self._witness_hash = hash256(self.serialize_segwit())[::-1]
+            self.mark_cached()
+        return self._witness_hash
+
+    def wtxid(self):
+        '''Human-readable hexadecimal of the witness hash'''
+        return self.witness_hash().hex()
+
     # tag::source2[]
     @classmethod
     def parse(cls, s, testnet=False):
@@ -160,6 +295,63 @@ class Tx:
                    testnet=testnet, segwit=True)
     # end::source3[]
 
+    @classmethod
+    def parse_buffer(cls, buf, offset=0, testnet=False):
+        '''Parses the transaction at offset of a bytes-like buffer by
+        walking a memoryview of it with an offset. When buf is read-only,
+        like bytes, long scripts and witness items stay views into it and
+        it must not change while the Tx is in use, a writable buf is
+        copied from. Scripts are only split into cmds when needed and
+        prevout hashes are only reversed when needed. Returns the Tx and
+        the offset just past it.'''
+        buf = memoryview(buf)
+        start = offset
+        version = int.from_bytes(buf[offset:offset + 4], 'little')
+        offset += 4
+        # a 0 where the number of inputs should be is the segwit marker
+        segwit = buf[offset] == 0
+        if segwit:
+            if buf[offset + 1] != 1:
+                raise RuntimeError('Not a segwit transaction {}'.format(
+                    bytes(buf[offset:offset + 2])))
+            offset += 2
+        num_inputs, offset = read_varint_buffer(buf, offset)
+        inputs = []
+        for _ in range(num_inputs):
+            tx_in, offset = TxIn.parse_buffer(buf, offset)
+            inputs.append(tx_in)
+        num_outputs, offset = read_varint_buffer(buf, offset)
+        outputs = []
+        for _ in range(num_outputs):
+            tx_out, offset = TxOut.parse_buffer(buf, offset)
+            outputs.append(tx_out)
+        if segwit:
+            for tx_in in inputs:
+                tx_in.witness, offset = parse_witness(buf, offset)
+        locktime = int.from_bytes(buf[offset:offset + 4], 'little')
+        offset += 4
+        if offset > len(buf):
+            raise SyntaxError('transaction runs past the end of the buffer')
+        tx = cls(version, inputs, outputs, locktime,
+                 testnet=testnet, segwit=segwit)
+        # keep the bytes we parsed as the serialization
+        tx._raw = buffer_slice(buf, start, offset)
+        tx.mark_cached()
+        return tx, offset
+
+    @classmethod
+    def parse_many(cls, buf, offset=0, testnet=False):
+        '''Parses a varint count followed by that many transactions, the
+        way they are laid out in a block. Returns the list of Txs and the
+        offset just past them.'''
+        buf = memoryview(buf)
+        count, offset = read_varint_buffer(buf, offset)
+        txs = []
+        for _ in range(count):
+            tx, offset = cls.parse_buffer(buf, offset, testnet=testnet)
+            txs.append(tx)
+        return txs, offset
+
     # tag::source4[]
     def serialize(self):
         if self.segwit:
@@ -167,35 +359,94 @@ class Tx:
         else:
             return self.serialize_legacy()
 
-    def serialize_legacy(self):  # <1>
-        result = int_to_little_endian(self.version, 4)
-        result += encode_varint(len(self.tx_ins))
+    def serialize_legacy(self):
+        '''The serialization without witnesses, cached'''
+        self.check_cache()
+        if self.segwit:
+            if self._legacy is None:
+                self._legacy = self.build_legacy()
+                self.mark_cached()
+            return self._legacy
+        if self._raw is None:
+            self._raw = self.build_legacy()
+            self.mark_cached()
+        return self.raw()
+
+    def serialize_segwit(self):
+        '''The serialization with witnesses, cached'''
+        if not self.segwit:
+            return self.build_segwit()
+        self.check_cache()
+        if self._raw is None:
+            self._raw = self.build_segwit()
+            self.mark_cached()
+        return self.raw()
+
+    def raw(self):
+        '''The cached serialization as bytes, it may be a view into the
+        buffer this transaction was parsed from'''
+        if type(self._raw) != bytes:
+            self._raw = bytes(self._raw)
+        return self._raw
+
+    def serialize_into(self, buf):
+        '''Appends the serialization to the bytearray buf, copying the
+        cached bytes when there are any'''
+        self.check_cache()
+        if self._raw is not None:
+            buf += self._raw
+        elif self.segwit:
+            self.serialize_segwit_into(buf)
+        else:
+            self.serialize_legacy_into(buf)
+
+    @classmethod
+    def serialize_many(cls, txs):
+        '''Serializes a varint count followed by the transactions into a
+        single buffer, the way parse_many reads them'''
+        result = bytearray(encode_varint(len(txs)))
+        for tx in txs:
+            tx.serialize_into(result)
+        return bytes(result)
+
+    def build_legacy(self):
+        result = bytearray()
+        self.serialize_legacy_into(result)
+        return bytes(result)
+
+    def build_segwit(self):
+        result = bytearray()
+        self.serialize_segwit_into(result)
+        return bytes(result)
+
+    def serialize_legacy_into(self, buf):  # <1>
+        buf += int_to_little_endian(self.version, 4)
+        buf += encode_varint(len(self.tx_ins))
         for tx_in in self.tx_ins:
-            result += tx_in.serialize()
-        result += encode_varint(len(self.tx_outs))
+            tx_in.serialize_into(buf)
+        buf += encode_varint(len(self.tx_outs))
         for tx_out in self.tx_outs:
-            result += tx_out.serialize()
-        result += int_to_little_endian(self.locktime, 4)
-        return result
+            tx_out.serialize_into(buf)
+        buf += int_to_little_endian(self.locktime, 4)
 
-    def serialize_segwit(self):
-        result = int_to_little_endian(self.version, 4)
-        result += b'\x00\x01'  # <2>
-        result += encode_varint(len(self.tx_ins))
+    def serialize_segwit_into(self, buf):
+        buf += int_to_little_endian(self.version, 4)
+        buf += b'\x00\x01'  # <2>
+        buf += encode_varint(len(self.tx_ins))
         for tx_in in self.tx_ins:
-            result += tx_in.serialize()
-        result += encode_varint(len(self.tx_outs))
+            tx_in.serialize_into(buf)
+        buf += encode_varint(len(self.tx_outs))
         for tx_out in self.tx_outs:
-            result += tx_out.serialize()
+            tx_out.serialize_into(buf)
         for tx_in in self.tx_ins:  # <3>
-            result += int_to_little_endian(len(tx_in.witness), 1)
+            buf.append(len(tx_in.witness))
             for item in tx_in.witness:
                 if type(item) == int:
-                    result += int_to_little_endian(item, 1)
+                    buf.append(item)
                 else:
-                    result += encode_varint(len(item)) + item
-        result += int_to_little_endian(self.locktime, 4)
-        return result
+                    buf += encode_varint(len(item))
+                    buf += item
+        buf += int_to_little_endian(self.locktime, 4)
     # end::source4[]
 
     def fee(self):
@@ -216,7 +467,7 @@ class Tx:
         signed for index input_index'''
         # start the serialization with version
         # use int_to_little_endian in 4 bytes
-        s = int_to_little_endian(self.version, 4)
+        s = bytearray(int_to_little_endian(self.version, 4))
         # add how many inputs there are using encode_varint
         s += encode_varint(len(self.tx_ins))
         # loop through each input using enumerate, so we have the input index
@@ -233,17 +484,18 @@ class Tx:
             else:
                 script_sig = None
             # add the serialization of the input with the ScriptSig we want
-            s += TxIn(
-                prev_tx=tx_in.prev_tx,
-                prev_index=tx_in.prev_index,
-                script_sig=script_sig,
-                sequence=tx_in.sequence,
-            ).serialize()
+            s += tx_in._prev_tx_le
+            s += int_to_little_endian(tx_in.prev_index, 4)
+            if script_sig is None:
+                s += b'\x00'
+            else:
+                script_sig.serialize_into(s)
+            s += int_to_little_endian(tx_in.sequence, 4)
         # add how many outputs there are using encode_varint
         s += encode_varint(len(self.tx_outs))
         # add the serialization of each output
         for tx_out in self.tx_outs:
-            s += tx_out.serialize()
+            tx_out.serialize_into(s)
         # add the locktime using int_to_little_endian in 4 bytes
         s += int_to_little_endian(self.locktime, 4)
         # add SIGHASH_ALL using int_to_little_endian in 4 bytes
@@ -255,13 +507,15 @@ class Tx:
 
     def hash_prevouts(self):
         if self._hash_prevouts is None:
-            all_prevouts = b''
-            all_sequence = b''
+            all_prevouts = bytearray()
+            all_sequence = bytearray()
             for tx_in in self.tx_ins:
-                all_prevouts += tx_in.prev_tx[::-1] + int_to_little_endian(tx_in.prev_index, 4)
+                all_prevouts += tx_in._prev_tx_le
+                all_prevouts += int_to_little_endian(tx_in.prev_index, 4)
                 all_sequence += int_to_little_endian(tx_in.sequence, 4)
             self._hash_prevouts = hash256(all_prevouts)
             self._hash_sequence = hash256(all_sequence)
+            self.mark_cached()
         return self._hash_prevouts
 
     def hash_sequence(self):
@@ -271,20 +525,26 @@ class Tx:
 
     def hash_outputs(self):
         if self._hash_outputs is None:
-            all_outputs = b''
+            all_outputs = bytearray()
             for tx_out in self.tx_outs:
-                all_outputs += tx_out.serialize()
+                tx_out.serialize_into(all_outputs)
             self._hash_outputs = hash256(all_outputs)
+            self.mark_cached()
         return self._hash_outputs
 
     def sig_hash_bip143(self, input_index, redeem_script=None, witness_script=None):
         '''Returns the integer representation of the hash that needs to get
         signed for index input_index'''
+        self.check_cache()
         tx_in = self.tx_ins[input_index]
         # per BIP143 spec
-        s = int_to_little_endian(self.version, 4)
-        s += self.hash_prevouts() + self.hash_sequence()
-        s += tx_in.prev_tx[::-1] + int_to_little_endian(tx_in.prev_index, 4)
+        # version, hashPrevouts and hashSequence are the same for every
+        # input, so their first sha256 block is only hashed once
+        if self._bip143_midstate is None:
+            self._bip143_midstate = sha256_midstate(
+                int_to_little_endian(self.version, 4)
+                + self.hash_prevouts() + self.hash_sequence())
+        s = tx_in._prev_tx_le + int_to_little_endian(tx_in.prev_index, 4)
         if witness_script:
             script_code = witness_script.serialize()
         elif redeem_script:
@@ -297,7 +557,7 @@ class Tx:
         s += self.hash_outputs()
         s += int_to_little_endian(self.locktime, 4)
         s += int_to_little_endian(SIGHASH_ALL, 4)
-        return int.from_bytes(hash256(s), 'big')
+        return int.from_bytes(hash256_from(self._bip143_midstate, s), 'big')
 
     def verify_input(self, input_index):
         '''Returns whether the input has a valid signature'''
@@ -344,17 +604,42 @@ class Tx:
         # evaluate the combined script
         return combined.evaluate(z, witness)
 
-    def verify(self):
+    def verify(self, executor=None):
         '''Verify this transaction'''
         # check that we're not creating money
         if self.fee() < 0:
             return False
+        if executor is not None:
+            return all(self.verify_inputs(executor))
         # check that each input has a valid ScriptSig
         for i in range(len(self.tx_ins)):
             if not self.verify_input(i):
                 return False
         return True
 
+    def verify_inputs(self, executor):
+        '''Returns a list of whether each input has a valid signature,
+        checking the inputs in parallel using the executor'''
+        raw = self.serialize()
+        payloads = []
+        # each worker gets the transaction once with the indexes of a run
+        # of inputs, so it's parsed once and the BIP143 parts are shared
+        for input_indexes in executor.split(range(len(self.tx_ins))):
+            # and each previous transaction it needs for the ScriptPubKeys
+            # and amounts once, however many inputs spend from it
+            prev_raws = {}
+            for i in input_indexes:
+                tx_in = self.tx_ins[i]
+                if tx_in.prev_tx not in prev_raws:
+                    prev_raws[tx_in.prev_tx] = tx_in.fetch_tx(
+                        self.testnet).serialize()
+            payloads.append(
+                (raw, self.testnet, list(input_indexes), prev_raws))
+        results = []
+        for result in executor.map(verify_input_job, payloads):
+            results.extend(result)
+        return results
+
     def sign_input(self, input_index, private_key):
         '''Signs the input using the private key'''
         # get the signature hash (z)
@@ -372,6 +657,33 @@ class Tx:
         # return whether sig is valid using self.verify_input
         return self.verify_input(input_index)
 
+    def sign_all(self, private_keys, executor=None):
+        '''Signs every input, private_keys is a list of one PrivateKey per
+        input or a single PrivateKey to sign all of them with. Returns
+        whether every input is now valid.'''
+        if isinstance(private_keys, PrivateKey):
+            private_keys = [private_keys] * len(self.tx_ins)
+        if len(private_keys) != len(self.tx_ins):
+            raise ValueError('need one private key per input')
+        # the sig hash of an input does not depend on the other ScriptSigs
+        # so we can get all of them before signing anything
+        payload = []
+        for i, private_key in enumerate(private_keys):
+            payload.append(
+                (private_key.secret, private_key.hardened, self.sig_hash(i)))
+        if executor is None:
+            signatures = sign_job(payload)
+        else:
+            signatures = []
+            for result in executor.map(sign_job, executor.split(payload)):
+                signatures.extend(result)
+        for tx_in, private_key, (r, s, recid) in zip(self.tx_ins, private_keys, signatures):
+            sig = Signature(r, s, recid).der() + SIGHASH_ALL.to_bytes(1, 'big')
+            tx_in.script_sig = Script([sig, private_key.point.sec()])
+        if executor is None:
+            return all(self.verify_input(i) for i in range(len(self.tx_ins)))
+        return all(self.verify_inputs(executor))
+
     def is_coinbase(self):
         '''Returns whether this transaction is a coinbase transaction or not'''
         # check that there is exactly 1 input
@@ -400,9 +712,225 @@ class Tx:
         return little_endian_to_int(first_cmd)
 
 
+class LazyTx(Tx):
+    '''A Tx that only records where its inputs, outputs and witnesses are
+    in its raw serialization and parses each of them the first time it's
+    used. serialize(), hash() and id() work straight from the raw bytes
+    until something changes, then everything is parsed and from there on
+    it behaves like a normal Tx.'''
+    __slots__ = ('_tx_ins', '_tx_outs', '_ins_offset', '_outs_offset',
+                 '_witness_offset')
+
+    def __init__(self, raw, version, locktime, counts, ins_offset,
+                 outs_offset, witness_offset, testnet=False, segwit=False):
+        # nothing can have changed yet, so skip the change hooks
+        set_fields(
+            self, version=version, locktime=locktime, testnet=testnet,
+            segwit=segwit, _tx_ins=None, _tx_outs=None, _raw=raw,
+            _items=(None, None), _ins_offset=ins_offset,
+            _outs_offset=outs_offset, _witness_offset=witness_offset)
+
+    @classmethod
+    def parse(cls, s, testnet=False):
+        '''Reads exactly one transaction from the stream s, collecting
+        its bytes for parse_buffer'''
+        raw = [s.read(4)]
+        segwit = s.read(1) == b'\x00'
+        if segwit:
+            # parse_buffer checks the flag
+            raw.append(b'\x00' + s.read(1))
+        else:
+            s.seek(-1, 1)
+        num_inputs = read_varint(s)
+        raw.append(encode_varint(num_inputs))
+        for _ in range(num_inputs):
+            # prev_tx and prev_index, then the ScriptSig and sequence
+            raw.append(s.read(36))
+            raw.append(read_length_prefixed(s))
+            raw.append(s.read(4))
+        num_outputs = read_varint(s)
+        raw.append(encode_varint(num_outputs))
+        for _ in range(num_outputs):
+            # amount, then the ScriptPubKey
+            raw.append(s.read(8))
+            raw.append(read_length_prefixed(s))
+        if segwit:
+            for _ in range(num_inputs):
+                num_items = read_varint(s)
+                raw.append(encode_varint(num_items))
+                for _ in range(num_items):
+                    raw.append(read_length_prefixed(s))
+        raw.append(s.read(4))
+        tx, _ = cls.parse_buffer(b''.join(raw), testnet=testnet)
+        return tx
+
+    @classmethod
+    def parse_legacy(cls, s, testnet=False):
+        return cls.parse(s, testnet=testnet)
+
+    @classmethod
+    def parse_segwit(cls, s, testnet=False):
+        return cls.parse(s, testnet=testnet)
+
+    @classmethod
+    def parse_buffer(cls, buf, offset=0, testnet=False):
+        '''Finds where each part of the transaction at offset of buf is
+        without building any TxIn, TxOut or Script. A read-only buf is
+        kept as a view, like Tx.parse_buffer, and must not change while
+        the LazyTx is in use. Returns the LazyTx and the offset just past
+        it.'''
+        buf = memoryview(buf)
+        start = offset
+        version = int.from_bytes(buf[offset:offset + 4], 'little')
+        offset += 4
+        segwit = buf[offset] == 0
+        if segwit:
+            if buf[offset + 1] != 1:
+                raise RuntimeError('Not a segwit transaction {}'.format(
+                    bytes(buf[offset:offset + 2])))
+            offset += 2
+        ins_offset = offset
+        num_inputs, offset = read_varint_buffer(buf, offset)
+        for _ in range(num_inputs):
+            # prev_tx and prev_index, then the ScriptSig and sequence
+            length, offset = read_varint_buffer(buf, offset + 36)
+            offset += length + 4
+        outs_offset = offset
+        num_outputs, offset = read_varint_buffer(buf, offset)
+        for _ in range(num_outputs):
+            # amount, then the ScriptPubKey
+            length, offset = read_varint_buffer(buf, offset + 8)
+            offset += length
+        witness_offset = offset
+        if segwit:
+            for _ in range(num_inputs):
+                num_items, offset = read_varint_buffer(buf, offset)
+                for _ in range(num_items):
+                    length, offset = read_varint_buffer(buf, offset)
+                    offset += length
+        locktime = int.from_bytes(buf[offset:offset + 4], 'little')
+        offset += 4
+        if offset > len(buf):
+            raise SyntaxError('transaction runs past the end of the buffer')
+        raw = buffer_slice(buf, start, offset)
+        return cls(raw, version, locktime, (num_inputs, num_outputs),
+                   ins_offset - start, outs_offset - start,
+                   witness_offset - start,
+                   testnet=testnet, segwit=segwit), offset
+
+    @property
+    def tx_ins(self):
+        if self._tx_ins is None:
+            buf = memoryview(self._raw)
+            num_inputs, offset = read_varint_buffer(buf, self._ins_offset)
+            tx_ins = []
+            for _ in range(num_inputs):
+                tx_in, offset = TxIn.parse_buffer(buf, offset)
+                tx_ins.append(tx_in)
+            if self.segwit:
+                offset = self._witness_offset
+                for tx_in in tx_ins:
+                    tx_in.witness, offset = parse_witness(buf, offset)
+            for tx_in in tx_ins:
+                tx_in._owner = self
+            self._tx_ins = tx_ins
+            if self._items is not None:
+                self._items = (list(tx_ins), self._items[1])
+        return self._tx_ins
+
+    @tx_ins.setter
+    def tx_ins(self, tx_ins):
+        self._tx_ins = tx_ins
+
+    @property
+    def tx_outs(self):
+        if self._tx_outs is None:
+            buf = memoryview(self._raw)
+            num_outputs, offset = read_varint_buffer(buf, self._outs_offset)
+            tx_outs = []
+            for _ in range(num_outputs):
+                tx_out, offset = TxOut.parse_buffer(buf, offset)
+                tx_out._owner = self
+                tx_outs.append(tx_out)
+            self._tx_outs = tx_outs
+            if self._items is not None:
+                self._items = (self._items[0], list(tx_outs))
+        return self._tx_outs
+
+    @tx_outs.setter
+    def tx_outs(self, tx_outs):
+        self._tx_outs = tx_outs
+
+    def invalidate(self):
+        # everything still only in the raw bytes has to be parsed before
+        # they are dropped
+        if self._raw is not None:
+            self.tx_ins
+            self.tx_outs
+        super().invalidate()
+
+    def holds(self, item):
+        # inputs and outputs that haven't been parsed aren't anywhere else
+        return ((self._tx_ins is not None and item in self._tx_ins)
+                or (self._tx_outs is not None and item in self._tx_outs))
+
+    def items_changed(self):
+        # inputs and outputs that haven't been parsed can't have changed
+        tx_ins, tx_outs = self._items
+        return ((tx_ins is not None and tx_ins != self._tx_ins)
+                or (tx_outs is not None and tx_outs != self._tx_outs))
+
+    def build_legacy(self):
+        if self._raw is None or not self.segwit:
+            return super().build_legacy()
+        # drop the marker, flag and witnesses from the raw bytes
+        raw = memoryview(self._raw)
+        return b''.join((raw[:4], raw[6:self._witness_offset], raw[-4:]))
+
+
+def read_length_prefixed(s):
+    '''Reads a varint length and that many bytes from the stream s and
+    returns both, serialized'''
+    length = read_varint(s)
+    return encode_varint(length) + s.read(length)
+
+
+def parse_witness(buf, offset):
+    '''Parses the witness items of one input at offset of a memoryview.
+    Returns the list of items and the offset just past them.'''
+    num_items, offset = read_varint_buffer(buf, offset)
+    items = []
+    for _ in range(num_items):
+        item_len, offset = read_varint_buffer(buf, offset)
+        if item_len == 0:
+            items.append(0)
+        else:
+            items.append(buffer_slice(buf, offset, offset + item_len))
+            offset += item_len
+    return items, offset
+
+
+def verify_input_job(payload):
+    '''Verifies some inputs for Executor.map. The payload is the raw
+    transaction, testnet, the input indexes and a dict of the raw previous
+    transactions they spend by id, so the worker never has to fetch
+    anything. Returns a list of whether each input is valid.'''
+    raw, testnet, input_indexes, prev_raws = payload
+    tx, _ = Tx.parse_buffer(raw, testnet=testnet)
+    for prev_tx, prev_raw in prev_raws.items():
+        TxFetcher.cache[prev_tx.hex()], _ = Tx.parse_buffer(
+            prev_raw, testnet=testnet)
+    return [tx.verify_input(i) for i in input_indexes]
+
+
 class TxIn:
+    # prev_tx is only kept little endian, the way it's serialized, and
+    # _owner is the Tx this input is in
+    __slots__ = ('_prev_tx_le', 'prev_index', 'script_sig', 'sequence',
+                 'witness', '_owner')
 
     def __init__(self, prev_tx, prev_index, script_sig=None, sequence=0xffffffff):
+        self._owner = None
         self.prev_tx = prev_tx
         self.prev_index = prev_index
         if script_sig is None:
@@ -411,6 +939,66 @@ class TxIn:
             self.script_sig = script_sig
         self.sequence = sequence
 
+    def __setattr__(self, name, value):
+        if name in TX_IN_FIELDS:
+            if self._owner is not None:
+                self._owner.invalidate()
+            if name == 'script_sig':
+                take_ownership(self, value)
+            elif name == 'witness':
+                # editing the witness in place tells the Tx too
+                value = TrackedList(value, self)
+        super().__setattr__(name, value)
+
+    def holds(self, script):
+        '''Whether script is the ScriptSig'''
+        return self.script_sig is script
+
+    def invalidate(self):
+        '''Tells the Tx this input is in that it changed'''
+        if self._owner is not None:
+            self._owner.invalidate()
+
+    def __copy__(self):
+        # a copy has its own ScriptSig and isn't in any Tx yet
+        tx_in = TxIn.__new__(type(self))
+        set_fields(
+            tx_in, _prev_tx_le=self._prev_tx_le, prev_index=self.prev_index,
+            script_sig=copy(self.script_sig), sequence=self.sequence,
+            _owner=None)
+        tx_in.script_sig._owner = tx_in
+        if hasattr(self, 'witness'):
+            object.__setattr__(
+                tx_in, 'witness', TrackedList(self.witness, tx_in))
+        return tx_in
+
+    def __deepcopy__(self, memo):
+        return copy(self)
+
+    def __getstate__(self):
+        state = {'_prev_tx_le': self._prev_tx_le,
+                 'prev_index': self.prev_index,
+                 'script_sig': self.script_sig, 'sequence': self.sequence}
+        if hasattr(self, 'witness'):
+            state['witness'] = list(self.witness)
+        return state
+
+    def __setstate__(self, state):
+        # an unpickled input isn't in any Tx yet, so skip the change hooks
+        set_fields(self, _owner=None, **state)
+        self.script_sig._owner = self
+        if 'witness' in state:
+            object.__setattr__(
+                self, 'witness', TrackedList(state['witness'], self))
+
+    @property
+    def prev_tx(self):
+        return self._prev_tx_le[::-1]
+
+    @prev_tx.setter
+    def prev_tx(self, prev_tx):
+        self._prev_tx_le = bytes(prev_tx[::-1])
+
     def __repr__(self):
         return '{}:{}'.format(
             self.prev_tx.hex(),
@@ -433,17 +1021,39 @@ class TxIn:
         # return an instance of the class (see __init__ for args)
         return cls(prev_tx, prev_index, script_sig, sequence)
 
+    @classmethod
+    def parse_buffer(cls, buf, offset):
+        '''Parses the input at offset of a memoryview.
+        Returns the TxIn and the offset just past it.'''
+        prev_index = int.from_bytes(buf[offset + 32:offset + 36], 'little')
+        script_sig, end = Script.parse_buffer(buf, offset + 36)
+        sequence = int.from_bytes(buf[end:end + 4], 'little')
+        # a new input has no owner to tell, so skip the change hooks
+        tx_in = cls.__new__(cls)
+        set_fields(
+            tx_in, _prev_tx_le=bytes(buf[offset:offset + 32]),
+            prev_index=prev_index, script_sig=script_sig, sequence=sequence,
+            _owner=None)
+        script_sig._owner = tx_in
+        return tx_in, end + 4
+
     def serialize(self):
         '''Returns the byte serialization of the transaction input'''
+        result = bytearray()
+        self.serialize_into(result)
+        return bytes(result)
+
+    def serialize_into(self, buf):
+        '''Appends the serialization of the transaction input to the
+        bytearray buf'''
         # serialize prev_tx, little endian
-        result = self.prev_tx[::-1]
+        buf += self._prev_tx_le
         # serialize prev_index, 4 bytes, little endian
-        result += int_to_little_endian(self.prev_index, 4)
+        buf += int_to_little_endian(self.prev_index, 4)
         # serialize the script_sig
-        result += self.script_sig.serialize()
+        self.script_sig.serialize_into(buf)
         # serialize sequence, 4 bytes, little endian
-        result += int_to_little_endian(self.sequence, 4)
-        return result
+        buf += int_to_little_endian(self.sequence, 4)
 
     def fetch_tx(self, testnet=False):
         return TxFetcher.fetch(self.prev_tx.hex(), testnet=testnet)
@@ -470,11 +1080,50 @@ class TxIn:
 
 
 class TxOut:
+    # _owner is the Tx this output is in
+    __slots__ = ('amount', 'script_pubkey', '_owner')
 
     def __init__(self, amount, script_pubkey):
+        self._owner = None
         self.amount = amount
         self.script_pubkey = script_pubkey
 
+    def __setattr__(self, name, value):
+        if name in TX_OUT_FIELDS:
+            if self._owner is not None:
+                self._owner.invalidate()
+            if name == 'script_pubkey':
+                take_ownership(self, value)
+        super().__setattr__(name, value)
+
+    def holds(self, script):
+        '''Whether script is the ScriptPubKey'''
+        return self.script_pubkey is script
+
+    def invalidate(self):
+        '''Tells the Tx this output is in that it changed'''
+        if self._owner is not None:
+            self._owner.invalidate()
+
+    def __copy__(self):
+        # a copy has its own ScriptPubKey and isn't in any Tx yet
+        tx_out = TxOut.__new__(type(self))
+        set_fields(tx_out, amount=self.amount,
+                   script_pubkey=copy(self.script_pubkey), _owner=None)
+        tx_out.script_pubkey._owner = tx_out
+        return tx_out
+
+    def __deepcopy__(self, memo):
+        return copy(self)
+
+    def __getstate__(self):
+        return {'amount': self.amount, 'script_pubkey': self.script_pubkey}
+
+    def __setstate__(self, state):
+        # an unpickled output isn't in any Tx yet, so skip the change hooks
+        set_fields(self, _owner=None, **state)
+        self.script_pubkey._owner = self
+
     def __repr__(self):
         return '{}:{}'.format(self.amount, self.script_pubkey)
 
@@ -490,13 +1139,32 @@ class TxOut:
         # return an instance of the class (see __init__ for args)
         return cls(amount, script_pubkey)
 
+    @classmethod
+    def parse_buffer(cls, buf, offset):
+        '''Parses the output at offset of a memoryview.
+        Returns the TxOut and the offset just past it.'''
+        amount = int.from_bytes(buf[offset:offset + 8], 'little')
+        script_pubkey, offset = Script.parse_buffer(buf, offset + 8)
+        # a new output has no owner to tell, so skip the change hooks
+        tx_out = cls.__new__(cls)
+        set_fields(tx_out, amount=amount, script_pubkey=script_pubkey,
+                   _owner=None)
+        script_pubkey._owner = tx_out
+        return tx_out, offset
+
     def serialize(self):
         '''Returns the byte serialization of the transaction output'''
+        result = bytearray()
+        self.serialize_into(result)
+        return bytes(result)
+
+    def serialize_into(self, buf):
+        '''Appends the serialization of the transaction output to the
+        bytearray buf'''
         # serialize amount, 8 bytes, little endian
-        result = int_to_little_endian(self.amount, 8)
+        buf += int_to_little_endian(self.amount, 8)
         # serialize the script_pubkey
-        result += self.script_pubkey.serialize()
-        return result
+        self.script_pubkey.serialize_into(buf)
 
 
 class TxTest(TestCase):
@@ -619,6 +1287,310 @@ class TxTest(TestCase):
         want = '010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d0000006b4830450221008ed46aa2cf12d6d81065bfabe903670165b538f65ee9a3385e6327d80c66d3b502203124f804410527497329ec4715e18558082d489b218677bd029e7fa306a72236012103935581e52c354cd2f484fe8ed83af7a3097005b2f9c60bff71d35bd795f54b67ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000'
         self.assertEqual(tx_obj.serialize().hex(), want)
 
+    def test_verify_executor(self):
+        tx_ids = (
+            ('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03', False),
+            ('46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b', False),
+            ('78457666f82c28aa37b74b506745a7c7684dc7842a52a457b09f09446721e11c', True),
+        )
+        with Executor(workers=2) as executor:
+            for tx_id, testnet in tx_ids:
+                tx = TxFetcher.fetch(tx_id, testnet=testnet)
+                self.assertTrue(tx.verify(executor))
+                self.assertEqual(tx.verify_inputs(executor), [True] * len(tx.tx_ins))
+        # one payload per worker, with each previous transaction once
+        private_key = PrivateKey(secret=8675309)
+        raw = bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000')
+        tx = Tx.parse(BytesIO(raw), testnet=True)
+        tx.tx_ins.append(copy(tx.tx_ins[0]))
+        self.assertTrue(tx.sign_all(private_key))
+        with Executor(workers=1) as executor, patch(
+                'tx.verify_input_job', wraps=verify_input_job) as job:
+            self.assertEqual(tx.verify_inputs(executor), [True, True])
+        (payload,), _ = job.call_args
+        self.assertEqual(job.call_count, 1)
+        self.assertEqual(payload[2], [0, 1])
+        self.assertEqual(list(payload[3]), [tx.tx_ins[0].prev_tx])
+
+    def test_sign_all(self):
+        private_key = PrivateKey(secret=8675309)
+        raw = bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000')
+        want = '010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d0000006b4830450221008ed46aa2cf12d6d81065bfabe903670165b538f65ee9a3385e6327d80c66d3b502203124f804410527497329ec4715e18558082d489b218677bd029e7fa306a72236012103935581e52c354cd2f484fe8ed83af7a3097005b2f9c60bff71d35bd795f54b67ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000'
+        tx_obj = Tx.parse(BytesIO(raw), testnet=True)
+        self.assertTrue(tx_obj.sign_all(private_key))
+        self.assertEqual(tx_obj.serialize().hex(), want)
+        tx_obj = Tx.parse(BytesIO(raw), testnet=True)
+        with Executor(workers=2) as executor:
+            self.assertTrue(tx_obj.sign_all([private_key], executor))
+        self.assertEqual(tx_obj.serialize().hex(), want)
+        with self.assertRaises(ValueError):
+            tx_obj.sign_all([private_key, private_key])
+        # hardened keys stay hardened on the way to sign_job
+        hardened = PrivateKey(secret=8675309, hardened=True)
+        tx_obj = Tx.parse(BytesIO(raw), testnet=True)
+        with patch('ecc.hardened_g_mul', wraps=hardened_g_mul) as spy:
+            self.assertTrue(tx_obj.sign_all(hardened))
+        self.assertTrue(spy.called)
+        self.assertEqual(tx_obj.serialize().hex(), want)
+
+    def test_parse_buffer(self):
+        raws = [tx.serialize() for tx in TxFetcher.cache.values()][:20]
+        for raw in raws:
+            want = Tx.parse(BytesIO(raw))
+            tx, offset = Tx.parse_buffer(raw)
+            self.assertEqual(offset, len(raw))
+            self.assertEqual(tx.serialize(), raw)
+            self.assertEqual(tx.id(), want.id())
+            self.assertEqual(tx.segwit, want.segwit)
+            for tx_in, want_in in zip(tx.tx_ins, want.tx_ins):
+                self.assertEqual(tx_in.prev_tx, want_in.prev_tx)
+                self.assertEqual(tx_in.script_sig.cmds, want_in.script_sig.cmds)
+            for tx_out, want_out in zip(tx.tx_outs, want.tx_outs):
+                self.assertEqual(tx_out.amount, want_out.amount)
+                self.assertEqual(tx_out.script_pubkey.cmds, want_out.script_pubkey.cmds)
+        # a block's transactions, starting after the header
+        block = b'\x00' * 80 + encode_varint(len(raws)) + b''.join(raws)
+        txs, offset = Tx.parse_many(block, 80)
+        self.assertEqual(offset, len(block))
+        self.assertEqual([tx.serialize() for tx in txs], raws)
+        # changing prev_tx changes the serialization
+        tx, _ = Tx.parse_buffer(raws[0])
+        tx.tx_ins[0].prev_tx = b'\x11' * 32
+        self.assertEqual(tx.tx_ins[0].serialize()[:32], b'\x11' * 32)
+        with self.assertRaises(SyntaxError):
+            Tx.parse_buffer(raws[0][:-1])
+        # no __dict__ anywhere, and prev_tx is only kept the way it's serialized
+        tx, _ = LazyTx.parse_buffer(raws[0])
+        for obj in (tx, tx.tx_ins[0], tx.tx_outs[0], tx.tx_outs[0].script_pubkey):
+            self.assertFalse(hasattr(obj, '__dict__'))
+        tx.tx_ins[0].prev_tx = b'\x11' * 31 + b'\x22'
+        self.assertEqual(tx.tx_ins[0]._prev_tx_le, b'\x22' + b'\x11' * 31)
+        with self.assertRaises(AttributeError):
+            tx.tx_ins[0].note = 'not a field'
+
+    def test_pickle(self):
+        raws = [tx.serialize() for tx in TxFetcher.cache.values()][:20]
+        for raw in raws:
+            for cls in (Tx, LazyTx):
+                tx, _ = cls.parse_buffer(raw, testnet=True)
+                tx_copy = pickle.loads(pickle.dumps(tx))
+                self.assertIs(type(tx_copy), cls)
+                self.assertTrue(tx_copy.testnet)
+                self.assertEqual(tx_copy.serialize(), raw)
+                self.assertEqual(tx_copy.id(), tx.id())
+        tx = Tx.parse(BytesIO(raws[0]))
+        old_id = tx.id()
+        tx_copy = pickle.loads(pickle.dumps(tx))
+        tx_copy.tx_ins[0].sequence = 5
+        self.assertEqual(tx.id(), old_id)
+        self.assertNotEqual(tx_copy.id(), old_id)
+        # inputs, outputs and scripts on their own, parsed or not
+        tx, _ = Tx.parse_buffer(next(raw for raw in raws if raw[4] == 0))
+        tx_in = pickle.loads(pickle.dumps(tx.tx_ins[0]))
+        self.assertEqual(tx_in.serialize(), tx.tx_ins[0].serialize())
+        self.assertEqual(tx_in.witness, tx.tx_ins[0].witness)
+        self.assertIs(tx_in.script_sig._owner, tx_in)
+        tx_out = pickle.loads(pickle.dumps(tx.tx_outs[0]))
+        self.assertEqual(tx_out.serialize(), tx.tx_outs[0].serialize())
+        tx_out.script_pubkey.cmds.append(0x51)
+        self.assertNotEqual(tx_out.serialize(), tx.tx_outs[0].serialize())
+        self.assertEqual(tx.serialize(), tx.build_segwit())
+
+    def test_serialize_into(self):
+        raws = [tx.serialize() for tx in TxFetcher.cache.values()]
+        block = encode_varint(len(raws)) + b''.join(raws)
+        # built from the parsed fields, and copied from the cached bytes
+        built = [Tx.parse(BytesIO(raw)) for raw in raws]
+        self.assertEqual(Tx.serialize_many(built), block)
+        self.assertEqual(Tx.serialize_many(Tx.parse_many(block)[0]), block)
+        self.assertEqual(Tx.serialize_many(LazyTx.parse_many(block)[0]), block)
+        for tx, raw in zip(built, raws):
+            buf = bytearray(b'\xff')
+            tx.serialize_into(buf)
+            self.assertEqual(buf, b'\xff' + raw)
+            self.assertEqual(tx.build_legacy(), Tx.parse(BytesIO(raw)).serialize_legacy())
+        # a script long enough for a 3 byte length
+        script = Script([b'\x01' * 300, 0xac, b'\x02' * 300])
+        buf = bytearray(b'\xff')
+        script.serialize_into(buf)
+        self.assertEqual(buf[1:4], b'\xfd' + (607).to_bytes(2, 'little'))
+        self.assertEqual(bytes(buf[1:]), script.serialize())
+        self.assertEqual(Script.parse(BytesIO(buf[1:])).cmds, script.cmds)
+
+    def test_lazy(self):
+        raws = [tx.serialize() for tx in TxFetcher.cache.values()]
+        block = encode_varint(len(raws)) + b''.join(raws)
+        lazy_txs, offset = LazyTx.parse_many(block)
+        self.assertEqual(offset, len(block))
+        for raw, tx in zip(raws, lazy_txs):
+            want = Tx.parse(BytesIO(raw))
+            self.assertIsNone(tx._tx_ins)
+            self.assertEqual(tx.id(), want.id())
+            self.assertEqual(tx.serialize(), raw)
+            self.assertEqual(tx.version, want.version)
+            self.assertEqual(tx.locktime, want.locktime)
+            self.assertEqual([o.amount for o in tx.tx_outs],
+                             [o.amount for o in want.tx_outs])
+            self.assertIsNone(tx._tx_ins)
+            for tx_in, want_in in zip(tx.tx_ins, want.tx_ins):
+                self.assertEqual(tx_in.prev_tx, want_in.prev_tx)
+                self.assertEqual(tx_in.script_sig.cmds, want_in.script_sig.cmds)
+                if want.segwit:
+                    self.assertEqual(tx_in.witness, want_in.witness)
+            self.assertEqual(tx.serialize(), raw)
+        # assigning a field switches to serializing the objects
+        tx, _ = LazyTx.parse_buffer(raws[0])
+        want = Tx.parse(BytesIO(raws[0]))
+        tx.locktime = want.locktime = 12345
+        self.assertEqual(tx.serialize(), want.serialize())
+        self.assertEqual(tx.id(), want.id())
+        # so does changing an output in place
+        tx, _ = LazyTx.parse_buffer(raws[0])
+        tx.tx_outs[0].amount += 1
+        self.assertNotEqual(tx.serialize(), raws[0])
+        self.assertEqual(Tx.parse(BytesIO(tx.serialize())).tx_outs[0].amount,
+                         want.tx_outs[0].amount + 1)
+        with self.assertRaises(SyntaxError):
+            LazyTx.parse_buffer(raws[0][:-1])
+        # from a stream, which is left just past the transaction
+        for raw in raws:
+            stream = BytesIO(raw + b'\xff')
+            tx = LazyTx.parse(stream)
+            self.assertEqual(stream.tell(), len(raw))
+            self.assertEqual(tx.serialize(), raw)
+            if tx.segwit:
+                tx = LazyTx.parse_segwit(BytesIO(raw))
+            else:
+                tx = LazyTx.parse_legacy(BytesIO(raw))
+            self.assertIsInstance(tx, LazyTx)
+            self.assertEqual(tx.id(), Tx.parse(BytesIO(raw)).id())
+        with self.assertRaises(SyntaxError):
+            LazyTx.parse(BytesIO(raws[0][:-1]))
+
+    def test_parse_writable_buffer(self):
+        raws = [tx.serialize() for tx in TxFetcher.cache.values()]
+        raw = max(raws, key=len)
+        want = Tx.parse(BytesIO(raw)).id()
+        for parser in (Tx, LazyTx):
+            # changing the buffer afterwards doesn't change the tx, whether
+            # it's serialized from the raw bytes or from its parts
+            for rebuild in (False, True):
+                buf = bytearray(raw)
+                tx, _ = parser.parse_buffer(buf)
+                buf[:] = bytes(len(buf))
+                if rebuild:
+                    tx.invalidate()
+                self.assertEqual(tx.serialize(), raw)
+                self.assertEqual(tx.id(), want)
+
+    def test_cache(self):
+        raws = [tx.serialize() for tx in TxFetcher.cache.values()]
+        for raw in raws:
+            tx, _ = Tx.parse_buffer(raw)
+            # ids are only hashed once
+            self.assertIs(tx.hash(), tx.hash())
+            self.assertEqual(tx.id(), hash256(tx.serialize_legacy())[::-1].hex())
+            if tx.segwit:
+                self.assertEqual(tx.wtxid(), hash256(raw)[::-1].hex())
+                self.assertNotEqual(tx.wtxid(), tx.id())
+            else:
+                self.assertEqual(tx.wtxid(), tx.id())
+        tx, _ = Tx.parse_buffer(raws[0])
+        old_id = tx.id()
+        # every kind of change gives a new id
+        changes = [
+            lambda tx: setattr(tx, 'locktime', tx.locktime + 1),
+            lambda tx: setattr(tx.tx_ins[0], 'sequence', 1),
+            lambda tx: setattr(tx.tx_ins[0].script_sig, 'cmds', [0x51]),
+            lambda tx: setattr(tx.tx_outs[0], 'amount', 1),
+            lambda tx: setattr(tx.tx_outs[0].script_pubkey, 'cmds', [0x51]),
+            lambda tx: tx.tx_outs.append(tx.tx_outs[0]),
+            lambda tx: tx.tx_ins.pop(),
+            lambda tx: tx.tx_ins.__setitem__(0, TxIn(b'\x11' * 32, 0)),
+            lambda tx: tx.tx_outs.__setitem__(0, TxOut(1, Script([0x51]))),
+            lambda tx: tx.tx_outs.reverse(),
+        ]
+        for change in changes:
+            tx, _ = Tx.parse_buffer(raws[0])
+            self.assertEqual(tx.id(), old_id)
+            change(tx)
+            self.assertNotEqual(tx.id(), old_id)
+            self.assertEqual(tx.serialize(), tx.build_legacy())
+        # so do edits to the cmds and witness lists in place
+        tx, _ = Tx.parse_buffer(raws[0])
+        tx.id()
+        tx.tx_outs[0].script_pubkey.cmds.append(0x51)
+        self.assertNotEqual(tx.id(), old_id)
+        self.assertEqual(tx.serialize(), tx.build_legacy())
+        tx, _ = Tx.parse_buffer(next(raw for raw in raws if raw[4] == 0))
+        old_wtxid = tx.wtxid()
+        tx.tx_ins[0].witness.append(b'\x01')
+        self.assertNotEqual(tx.wtxid(), old_wtxid)
+        self.assertEqual(tx.serialize(), tx.build_segwit())
+        # a Tx keeps the lists it was given, and sees changes made to them
+        tx_ins = [TxIn(b'\x11' * 32, 0)]
+        tx_outs = [TxOut(1, p2pkh_script(bytes(20)))]
+        tx = Tx(1, tx_ins, tx_outs, 0)
+        self.assertIs(tx.tx_ins, tx_ins)
+        tx_id = tx.id()
+        tx_ins.append(TxIn(b'\x22' * 32, 0))
+        self.assertNotEqual(tx.id(), tx_id)
+        self.assertEqual(tx.serialize(), tx.build_legacy())
+        # inputs, outputs and scripts can only be in one place at a time
+        tx, _ = Tx.parse_buffer(raws[0])
+        other = Tx(1, tx.tx_ins, tx.tx_outs, 0)
+        tx_id = tx.id()
+        tx.tx_ins[0].sequence = 5
+        self.assertNotEqual(tx.id(), tx_id)
+        with self.assertRaises(ValueError):
+            other.id()
+        other = Tx(1, [copy(i) for i in tx.tx_ins],
+                   [copy(o) for o in tx.tx_outs], 0)
+        other.id()
+        script_pubkey = p2pkh_script(bytes(20))
+        TxOut(1, script_pubkey)
+        with self.assertRaises(ValueError):
+            TxOut(2, script_pubkey)
+        # one that was taken out can be used elsewhere
+        tx_in = tx.tx_ins.pop()
+        tx_id = other.id()
+        other.tx_ins.append(tx_in)
+        self.assertNotEqual(other.id(), tx_id)
+        tx.id()
+        tx_in.sequence = 6
+        self.assertEqual(other.serialize(), other.build_legacy())
+        # the same with a lazy tx whose inputs were never parsed
+        tx, _ = LazyTx.parse_buffer(raws[0])
+        tx.id()
+        tx.tx_outs.append(TxOut(1, Script([0x51])))
+        self.assertNotEqual(tx.id(), old_id)
+        self.assertEqual(tx.serialize(), tx.build_legacy())
+        # items added later tell the tx when they change, like signing does
+        private_key = PrivateKey(secret=8675309)
+        raw = bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000')
+        want, _ = Tx.parse_buffer(raw, testnet=True)
+        want.sign_input(0, private_key)
+        tx, _ = Tx.parse_buffer(raw, testnet=True)
+        tx_in = tx.tx_ins.pop()
+        tx.id()
+        tx.tx_ins.append(TxIn(tx_in.prev_tx, tx_in.prev_index))
+        tx.id()
+        self.assertTrue(tx.sign_input(0, private_key))
+        self.assertEqual(tx.serialize(), want.serialize())
+        self.assertEqual(tx.id(), want.id())
+        # copies keep track of their own inputs and outputs
+        for copier in (copy, deepcopy):
+            tx, _ = Tx.parse_buffer(raws[0])
+            tx_copy = copier(tx)
+            self.assertEqual(tx_copy.id(), old_id)
+            tx.tx_ins[0].sequence = 1
+            self.assertNotEqual(tx.id(), old_id)
+            self.assertEqual(tx_copy.id(), old_id)
+            tx_copy.tx_outs[0].script_pubkey.cmds = [0x51]
+            self.assertNotEqual(tx_copy.id(), old_id)
+            self.assertEqual(tx.serialize(), tx.build_legacy())
+            self.assertEqual(tx_copy.serialize(), tx_copy.build_legacy())
+
     def test_is_coinbase(self):
         raw_tx = bytes.fromhex('01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff5e03d71b07254d696e656420627920416e74506f6f6c20626a31312f4542312f4144362f43205914293101fabe6d6d678e2c8c34afc36896e7d9402824ed38e856676ee94bfdb0c6c4bcd8b2e5666a0400000000000000c7270000a5e00e00ffffffff01faf20b58000000001976a914338c84849423992471bffb1a54a8d9b1d69dc28a88ac00000000')
         stream = BytesIO(raw_tx)